@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Batch Module """
+
+import json
+import sys
+import threading
+from collections.abc import Callable
+from pathlib import Path
+from logger_module import Logger
+
+# Options an account of the batch may set, others are taken from the CLI
+ACCOUNT_KEYS = ('username', 'password', 'session_file', 'm3u_output',
+                'xmltv_output', 'xmltv_plain', 'xmltv_shard', 'mode',
+                'limit', 'include_channel', 'exclude_channel', 'epg_state')
+
+# Options naming files an account writes in the generator modes, they must
+# differ across accounts
+ACCOUNT_FILE_KEYS = {
+    'session_file': ('all', 'epg', 'm3u'),
+    'm3u_output': ('all', 'm3u'),
+    'xmltv_output': ('all', 'epg'),
+    'epg_state': ('all', 'epg')
+}
+
+def _is_valid_option(key: str=None, value=None) -> bool:
+    """ Check the account option value is of the type the CLI gives it """
+
+    if key == 'limit':
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    if key == 'xmltv_plain':
+        return isinstance(value, bool)
+
+    if key in ('include_channel', 'exclude_channel'):
+        return (isinstance(value, list)
+                and all(isinstance(rule, str) for rule in value))
+
+    # Files of the account may be left unset
+    if key in ('session_file', 'epg_state', 'xmltv_shard'):
+        return value is None or isinstance(value, str)
+
+    return isinstance(value, str)
+
+def load_accounts(file: str=None) -> list[dict]:
+    """
+    Load accounts of the batch config file, raise ValueError if invalid
+
+    The config is a JSON object with a list of accounts, each one is an
+    object of options named as the CLI options destinations, e.g.
+    {"accounts": [{"username": "...", "password": "...",
+    "m3u_output": "home.m3u", "xmltv_output": "home.xml"}]}
+    """
+
+    try:
+        config = json.loads(Path(file).read_text(encoding='utf8'))
+    except OSError as err:
+        raise ValueError(f'cannot read batch config {file}: {err}') from None
+    except ValueError as err:
+        raise ValueError(f'invalid batch config {file}: {err}') from None
+
+    accounts = config.get('accounts') if isinstance(config, dict) else None
+    if not isinstance(accounts, list) or not accounts:
+        raise ValueError(f'batch config {file} does not list any accounts')
+
+    for index, account in enumerate(accounts, 1):
+        if not isinstance(account, dict):
+            raise ValueError(f'account {index} of batch config {file} is '
+                             f'not an object')
+
+        unknown_keys = set(account) - set(ACCOUNT_KEYS)
+        if unknown_keys:
+            raise ValueError(f'account {index} of batch config {file} sets '
+                             f'unknown options: '
+                             f'{", ".join(sorted(unknown_keys))}')
+
+        for key, value in account.items():
+            if not _is_valid_option(key, value):
+                raise ValueError(f'account {index} of batch config {file} '
+                                 f'sets invalid {key}: '
+                                 f'{json.dumps(value, ensure_ascii=False)}')
+
+        if not account.get('username') or not account.get('password'):
+            raise ValueError(f'account {index} of batch config {file} must '
+                             f'set username and password')
+
+        if account.get('mode', 'all') not in ('all', 'epg', 'm3u'):
+            raise ValueError(f'account {index} of batch config {file} sets '
+                             f'invalid mode: {account.get("mode")}')
+
+        if account.get('xmltv_shard') not in (None, 'genre', 'day'):
+            raise ValueError(f'account {index} of batch config {file} sets '
+                             f'invalid xmltv_shard: '
+                             f'{account.get("xmltv_shard")}')
+
+    return accounts
+
+class EPGShare:
+    """
+    EPG programs collected once per channel and shared across accounts
+
+    Programs do not depend on the account, so the first account to need a
+    channel collects it while the others wait for the result. Failed
+    collections are not shared, the next account tries again. Programs are
+    kept for the whole batch
+    """
+
+    def __init__(self, loglevel: int=20) -> None:
+        self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._programs: dict[str, list[tuple]] = {}
+        self._pending: dict[str, threading.Event] = {}
+
+    def fetch(self, channel_id: str=None,
+                fetcher: Callable[[], list[tuple] | None]=None
+                ) -> tuple[list[tuple] | None, bool]:
+        """
+        Return programs of the channel and whether they were collected for
+        another account, collect them with the fetcher otherwise
+        """
+
+        while True:
+            with self._lock:
+                if channel_id in self._programs:
+                    return self._programs[channel_id], True
+
+                event = self._pending.get(channel_id)
+                if event is None:
+                    event = self._pending[channel_id] = threading.Event()
+                    break
+
+            event.wait()
+
+        programs = None
+        try:
+            programs = fetcher()
+        finally:
+            with self._lock:
+                if programs is not None:
+                    self._programs[channel_id] = programs
+                del self._pending[channel_id]
+            event.set()
+
+        return programs, False
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
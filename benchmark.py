@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+""" Smotreshka Live TV Ripper: End-to-end Benchmark """
+
+import argparse
+import json
+import resource
+import statistics
+import tempfile
+import time
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict
+from pathlib import Path
+from logger_module import Logger
+from main import build_epg_listing, build_m3u_playlist, run_pipeline
+from mock_module import MockConfig, MockSmotreshkaServer
+from output_module import atomic_open
+from smotreshka_module import Smotreshka
+
+def get_args() -> argparse.Namespace:
+    """ Parse CLI arguments """
+
+    args_parser = argparse.ArgumentParser(
+            description='Smotreshka Live TV Ripper end-to-end benchmark '
+                        'against a local mock Smotreshka API')
+    args_parser.add_argument(
+                '--channels',
+                type=int,
+                default=100,
+                help='Number of mock channels. Default: 100'
+            )
+    args_parser.add_argument(
+                '--programs',
+                type=int,
+                default=150,
+                help='Number of mock EPG programs per channel. Default: 150'
+            )
+    args_parser.add_argument(
+                '--latency',
+                type=float,
+                default=0.03,
+                help='Base mock response latency in seconds. Default: 0.03'
+            )
+    args_parser.add_argument(
+                '--tail-ratio',
+                type=float,
+                default=0.05,
+                help='Share of mock responses delayed by the tail latency. '
+                     'Default: 0.05'
+            )
+    args_parser.add_argument(
+                '--tail-latency',
+                type=float,
+                default=0.5,
+                help='Extra latency of delayed mock responses in seconds. '
+                     'Default: 0.5'
+            )
+    args_parser.add_argument(
+                '--error-rate',
+                type=float,
+                default=0,
+                help='Share of mock programs and playback-info responses '
+                     'failed with 503. Default: 0'
+            )
+    args_parser.add_argument(
+                '--seed',
+                type=int,
+                default=0,
+                help='Seed of the mock latency and error distributions. '
+                     'Default: 0'
+            )
+    args_parser.add_argument(
+                '-r', '--repeat',
+                type=int,
+                default=1,
+                help='Number of benchmark runs. Default: 1'
+            )
+    args_parser.add_argument(
+                '-c', '--concurrency',
+                type=int,
+                default=8,
+                help='Number of parallel requests to the mock API. Default: 8'
+            )
+    args_parser.add_argument(
+                '-m', '--mode',
+                type=str,
+                help='Generator mode. Default: all',
+                choices=['all', 'epg', 'm3u'],
+                default='all'
+            )
+    args_parser.add_argument(
+                '-P', '--pipeline',
+                help='Write output files channel by channel while collecting '
+                     'data. Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '--xmltv-utc',
+                help='Write XMLTV times in UTC instead of the local time zone. '
+                     'Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '--report',
+                type=str,
+                default=None,
+                help='JSON file to write the benchmark report to. '
+                     'Default: not set'
+            )
+    args_parser.add_argument(
+        '--verbose', '-v', help='Enable verbose output of the measured '
+        'client. Default: 0', required=False, default=0, action='count'
+    )
+
+    args_parsed = args_parser.parse_args()
+
+    # Client logs only warnings by default, logging would dominate otherwise
+    args_parsed.verbose = max(10, 30 - 10 * int(args_parsed.verbose))
+
+    return args_parsed
+
+def get_peak_rss() -> float:
+    """ Return peak resident set size of the process in MiB """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+@contextmanager
+def measure(stages: dict, name: str=None) -> Iterator[None]:
+    """ Record wall time of the stage """
+
+    started = time.perf_counter()
+    yield
+    stages[name] = round(time.perf_counter() - started, 4)
+
+def run_once(server: MockSmotreshkaServer, args: argparse.Namespace,
+                output_dir: Path=None) -> dict:
+    """ Run the client end to end against the mock API, return results """
+
+    args.xmltv_output = str(output_dir / 'smotreshka.xmltv.xml')
+    args.m3u_output = str(output_dir / 'smotreshka.m3u')
+    args.xmltv_plain = False
+    args.skip_unchanged = False
+
+    stats_before = Counter(server.get_stats())
+    stages = {}
+    started = time.perf_counter()
+
+    # Smotreshka logs in and lists the channels once constructed
+    with measure(stages, 'login_channels'):
+        smotreshka_obj = Smotreshka(
+                            username='benchmark@example.com',
+                            password='benchmark',
+                            mode=args.mode,
+                            concurrency=args.concurrency,
+                            prefetch=False,
+                            base_url=server.base_url,
+                            loglevel=args.verbose
+                        )
+
+    if args.pipeline:
+        with measure(stages, 'pipeline'):
+            run_pipeline(smotreshka_obj, args)
+    else:
+        with measure(stages, 'collect'):
+            smotreshka_obj.collect()
+
+        smotreshka_channels = smotreshka_obj.get_channels()
+
+        if args.mode in ('all', 'epg'):
+            with measure(stages, 'render_epg'):
+                build_epg_listing(smotreshka_channels, args).write_epg_listing(
+                                                            args.xmltv_output)
+
+        if args.mode in ('all', 'm3u'):
+            with measure(stages, 'render_m3u'):
+                build_m3u_playlist(smotreshka_channels,
+                                    args.verbose).write_m3u_playlist(
+                                                            args.m3u_output)
+
+    wall_time = round(time.perf_counter() - started, 4)
+    stats = Counter(server.get_stats())
+    stats.subtract(stats_before)
+
+    return {
+        'wall_time': wall_time,
+        'stages': stages,
+        'requests': dict(sorted((name, count)
+                                for name, count in stats.items() if count)),
+        'request_count': sum(stats.values()),
+        'peak_rss_mib': round(get_peak_rss(), 1)
+    }
+
+if __name__ == '__main__':
+
+    args = get_args()
+    lgr = Logger(classname=__name__)
+
+    mock_config = MockConfig(
+                    channels=args.channels,
+                    programs=args.programs,
+                    latency=args.latency,
+                    tail_ratio=args.tail_ratio,
+                    tail_latency=args.tail_latency,
+                    error_rate=args.error_rate,
+                    seed=args.seed
+                )
+
+    runs = []
+
+    with MockSmotreshkaServer(mock_config) as mock_server, \
+        tempfile.TemporaryDirectory(prefix='smotreshka-benchmark-') as temp_dir:
+
+        for run in range(args.repeat):
+            result = run_once(mock_server, args, Path(temp_dir))
+            runs.append(result)
+
+            lgr.logger.info(
+                'Run %d/%d: wall time %.3fs, stages %s, %d requests %s, '
+                'peak RSS %.1f MiB', run + 1, args.repeat,
+                result['wall_time'], result['stages'],
+                result['request_count'], result['requests'],
+                result['peak_rss_mib'])
+
+    report = {
+        'config': asdict(mock_config),
+        'concurrency': args.concurrency,
+        'mode': args.mode,
+        'pipeline': args.pipeline,
+        'runs': runs,
+        'wall_time_median': round(statistics.median(
+                                    run['wall_time'] for run in runs), 4),
+        'stages_median': {
+            stage: round(statistics.median(
+                                run['stages'][stage] for run in runs), 4)
+            for stage in runs[0]['stages']
+        },
+        # Peak RSS only grows within the process, later runs include earlier
+        'peak_rss_mib': runs[-1]['peak_rss_mib']
+    }
+
+    lgr.logger.info('Median wall time %.3fs, stages %s, peak RSS %.1f MiB',
+        report['wall_time_median'], report['stages_median'],
+        report['peak_rss_mib'])
+
+    if args.report is not None:
+        with atomic_open(file=args.report) as report_file:
+            json.dump(report, report_file, indent=4)
+
+        lgr.logger.info('Please find the benchmark report\n\t- %s',
+            Path(args.report).resolve())
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Cache Module """
+
+import copy
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+import requests
+from requests.structures import CaseInsensitiveDict
+from logger_module import Logger
+
+# Default time to live in seconds of the cached responses per endpoint
+DEFAULT_TTLS = {
+    'channels': 3300,
+    'programs': 3300,
+    'playback-info': 0
+}
+
+class ResponseCache:
+    """
+    On-disk HTTP response cache with conditional revalidation
+
+    Fresh responses are served without a request. Expired responses carrying
+    ETag or Last-Modified are revalidated with If-None-Match and
+    If-Modified-Since, and a 304 answer is served from the cache. The total
+    size of cached bodies is bounded, least recently used entries are
+    evicted first
+    """
+
+    def __init__(self, directory: str=None, max_size: int=256 << 20,
+                    ttls: dict=None, namespace: str='',
+                    loglevel: int=20) -> None:
+
+        self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
+        self._directory = Path(directory)
+        self._max_size = max_size
+        self._ttls = DEFAULT_TTLS | (ttls or {})
+        self._namespace = namespace
+        self._lock = threading.Lock()
+
+        # key -> [size, last access time] of cached bodies
+        self._index: dict[str, list] = {}
+
+        self._directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self) -> None:
+        """ Build LRU index from cached bodies on disk """
+
+        for body_path in self._directory.glob('*.body'):
+            stat = body_path.stat()
+            self._index[body_path.stem] = [stat.st_size, stat.st_mtime]
+
+        self._lgr.logger.debug('Loaded %d cached responses from %s',
+            len(self._index), self._directory)
+
+    def namespaced(self, namespace: str='') -> 'ResponseCache':
+        """
+        Return the cache keyed within another namespace, sharing the cached
+        bodies, the index and the size bound with this one
+        """
+
+        cache = copy.copy(self)
+        cache._namespace = namespace # pylint: disable=protected-access
+
+        return cache
+
+    def _make_key(self, url: str=None) -> str:
+        """ Return cache key for the URL within the namespace """
+
+        return hashlib.sha256(
+            f'{self._namespace}\n{url}'.encode('utf8')).hexdigest()
+
+    @staticmethod
+    def _write_file(path: Path=None, content: bytes=None) -> None:
+        """ Replace file content atomically """
+
+        file_descriptor, temp_name = tempfile.mkstemp(
+                                    dir=path.parent, prefix=f'.{path.name}.')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                temp_file.write(content)
+            os.replace(temp_name, path)
+        except BaseException:
+            Path(temp_name).unlink(missing_ok=True)
+            raise
+
+    def _read_entry(self, key: str=None) -> tuple[dict, bytes] | None:
+        """ Return cached metadata and body, None if not cached """
+
+        try:
+            meta = json.loads(
+                    (self._directory / f'{key}.json').read_text('utf8'))
+            body = (self._directory / f'{key}.body').read_bytes()
+        except (OSError, ValueError):
+            return None
+
+        return meta, body
+
+    def _touch(self, key: str=None) -> None:
+        """ Mark entry as recently used """
+
+        now = time.time()
+
+        with self._lock:
+            if key in self._index:
+                self._index[key][1] = now
+
+        try:
+            os.utime(self._directory / f'{key}.body', (now, now))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """ Remove least recently used entries above the size bound """
+
+        with self._lock:
+            total_size = sum(size for size, _ in self._index.values())
+            if total_size <= self._max_size:
+                return
+
+            for key, (size, _) in sorted(self._index.items(),
+                                            key=lambda item: item[1][1]):
+                if total_size <= self._max_size:
+                    break
+
+                del self._index[key]
+                total_size -= size
+
+                for suffix in ('.body', '.json'):
+                    (self._directory / f'{key}{suffix}').unlink(
+                                                            missing_ok=True)
+
+                self._lgr.logger.debug('Evict cached response %s', key)
+
+    @staticmethod
+    def _make_response(url: str=None, meta: dict=None,
+                        body: bytes=None) -> requests.Response:
+        """ Build response object from cached data """
+
+        response = requests.Response()
+        response.status_code = meta['status']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.url = url
+        response.encoding = requests.utils.get_encoding_from_headers(
+                                                            response.headers)
+        response._content = body # pylint: disable=protected-access
+        response._content_consumed = True # pylint: disable=protected-access
+
+        return response
+
+    def lookup(self, url: str=None,
+                endpoint: str=None) -> tuple[requests.Response | None, dict]:
+        """
+        Look up cached response for the URL
+
+        Return the cached response if it is still fresh, otherwise None and
+        the conditional headers to revalidate the cached response with
+        """
+
+        key = self._make_key(url)
+        entry = self._read_entry(key)
+
+        if entry is None:
+            return None, {}
+
+        meta, body = entry
+
+        if time.time() - meta['stored'] < self._ttls.get(endpoint, 0):
+            self._lgr.logger.debug('Cache hit for %s', url)
+            self._touch(key)
+
+            return self._make_response(url, meta, body), {}
+
+        conditional_headers = {}
+        if 'etag' in meta['headers']:
+            conditional_headers['If-None-Match'] = meta['headers']['etag']
+        if 'last-modified' in meta['headers']:
+            conditional_headers['If-Modified-Since'] = \
+                meta['headers']['last-modified']
+
+        return None, conditional_headers
+
+    def revalidated(self, url: str=None) -> requests.Response | None:
+        """ Refresh cached response confirmed by 304 and return it """
+
+        key = self._make_key(url)
+        entry = self._read_entry(key)
+
+        if entry is None:
+            return None
+
+        meta, body = entry
+        meta['stored'] = time.time()
+        self._write_file(self._directory / f'{key}.json',
+                            json.dumps(meta).encode('utf8'))
+        self._touch(key)
+
+        self._lgr.logger.debug('Cached response for %s is not modified', url)
+
+        return self._make_response(url, meta, body)
+
+    def store(self, url: str=None, response: requests.Response=None) -> None:
+        """ Store successful response """
+
+        if response.status_code != requests.codes.ok: # pylint: disable=no-member
+            return
+
+        key = self._make_key(url)
+        body = response.content
+        meta = {
+            'url': url,
+            'status': response.status_code,
+            'stored': time.time(),
+            'headers': {
+                name.lower(): response.headers[name]
+                for name in ('Content-Type', 'ETag', 'Last-Modified')
+                if name in response.headers
+            }
+        }
+
+        self._write_file(self._directory / f'{key}.body', body)
+        self._write_file(self._directory / f'{key}.json',
+                            json.dumps(meta).encode('utf8'))
+
+        with self._lock:
+            self._index[key] = [len(body), time.time()]
+
+        self._evict()
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
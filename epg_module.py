@@ -1,18 +1,143 @@
 #!/usr/bin/env python3
 """ Smotreshka LiveTV Ripper: EPG Module """
 
+import hashlib
 import json
 import sys
 import html
-from dataclasses import dataclass, field, asdict
-from datetime import datetime
+import re
+import time
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from dataclasses import dataclass, field, fields
+from datetime import date, timedelta
+from typing import ClassVar, TextIO
 from logger_module import Logger
+from output_module import write_output
 
-@dataclass
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Part of the XMLTV header changing on every run regardless of the content
+XMLTV_VOLATILE = re.compile(r' date="[^"]*"')
+
+class XMLTVTimeFormatter:
+    """
+    Format unix epoch timestamps as XMLTV date-time values
+
+    Zone offsets practically change on 15 minute boundaries, so the local
+    offset is resolved once per such time slot and the date part once per
+    day. The rest is plain arithmetic. Time slots containing an offset
+    change are resolved per timestamp. Timestamps are processed in batches
+    with NumPy if it is installed
+    """
+
+    _slot: int = 900
+    _epoch: date = date(1970, 1, 1)
+
+    # Below this size NumPy array setup costs more than it saves
+    _batch_threshold: int = 64
+
+    def __init__(self, utc: bool=False) -> None:
+        self._utc = utc
+        self._slot_offsets: dict[int, tuple[int, str] | None] = {}
+        self._offsets: dict[int, tuple[int, str]] = {}
+        self._dates: dict[int, str] = {}
+
+    def _get_offset(self, timestamp: int) -> tuple[int, str]:
+        """ Return zone offset in seconds and as a string for the timestamp """
+
+        seconds = 0 if self._utc else time.localtime(timestamp).tm_gmtoff
+        offset = self._offsets.get(seconds)
+
+        if offset is None:
+            hours, minutes = divmod(abs(seconds) // 60, 60)
+            offset = (seconds,
+                      f'{"-" if seconds < 0 else "+"}{hours:02d}{minutes:02d}')
+            self._offsets[seconds] = offset
+
+        return offset
+
+    def _get_slot_offset(self, slot: int) -> tuple[int, str] | None:
+        """ Return zone offset of the time slot, None if it changes inside """
+
+        if slot in self._slot_offsets:
+            return self._slot_offsets[slot]
+
+        offset = self._get_offset(slot * self._slot)
+        if offset != self._get_offset((slot + 1) * self._slot - 1):
+            offset = None
+
+        self._slot_offsets[slot] = offset
+
+        return offset
+
+    def _get_date(self, day: int) -> str:
+        """ Return date string for the number of days since the epoch """
+
+        date_str = self._dates.get(day)
+
+        if date_str is None:
+            date_str = (self._epoch + timedelta(days=day)).strftime('%Y%m%d')
+            self._dates[day] = date_str
+
+        return date_str
+
+    def format(self, timestamp: int=None) -> str:
+        """ Format a single timestamp """
+
+        timestamp = int(timestamp)
+        offset_seconds, offset = (self._get_slot_offset(timestamp // self._slot)
+                                    or self._get_offset(timestamp))
+        day, seconds = divmod(timestamp + offset_seconds, 86400)
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+
+        return (f'{self._get_date(day)}'
+                f'{hours:02d}{minutes:02d}{seconds:02d} {offset}')
+
+    def format_many(self, timestamps: Sequence[int]=None) -> list[str]:
+        """ Format a batch of timestamps """
+
+        if numpy is None or len(timestamps) < self._batch_threshold:
+            return [self.format(timestamp) for timestamp in timestamps]
+
+        stamps = numpy.asarray(timestamps).astype(numpy.int64)
+        slots, slot_index = numpy.unique(
+                                stamps // self._slot, return_inverse=True)
+        slot_index = slot_index.ravel()
+        offsets = [self._get_slot_offset(slot) for slot in slots.tolist()]
+
+        if None in offsets:
+            return [self.format(timestamp) for timestamp in timestamps]
+
+        local = stamps + numpy.array(
+                    [offset[0] for offset in offsets],
+                    dtype=numpy.int64)[slot_index]
+        days, seconds = numpy.divmod(local, 86400)
+        clock = (seconds // 3600 * 10000
+                 + seconds // 60 % 60 * 100
+                 + seconds % 60)
+
+        return [
+            f'{self._get_date(day)}{hhmmss:06d} {offsets[index][1]}'
+            for day, hhmmss, index in zip(
+                days.tolist(), clock.tolist(), slot_index.tolist())
+        ]
+
+LOCAL_TIME_FORMATTER = XMLTVTimeFormatter()
+
+@dataclass(slots=True)
 class EPGProgramEntry:
     """
     EPG program entity from XMLTV standard
 
+    Program entries are the most numerous objects, so they are kept compact:
+    no per-instance __dict__ and no per-instance logger. The channel_id and
+    category attributes are expected to reference objects shared by all
+    programs of the same channel
+
     Attributes
     ----------
     channel_id: str
@@ -39,10 +164,11 @@ class EPGProgramEntry:
     category: list[str] = None
     icon: str = None
 
-    def __post_init__(self, loglevel: int=20) -> None:
+    _lgr: ClassVar[Logger] = Logger(classname='EPGProgramEntry')
+
+    def __post_init__(self) -> None:
         """ Post init preparations """
 
-        self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
         self._validate()
 
     def __str__(self) -> str:
@@ -50,7 +176,7 @@ class EPGProgramEntry:
 
         return_obj = {}
 
-        for key, value in self.__dict__.items():
+        for key, value in self.make_dict().items():
             return_obj[key] = {
                 'value': value,
                 'type': type(value).__name__
@@ -72,7 +198,7 @@ class EPGProgramEntry:
     def make_dict(self) -> dict:
         """ Return current class as a dict """
 
-        return self.__dict__
+        return {attr.name: getattr(self, attr.name) for attr in fields(self)}
 
 @dataclass
 class EPGChannelEntry:
@@ -142,58 +268,67 @@ class EPGChannelEntry:
 
         return None
 
-    def make_epg_entry(self) -> str:
-        """
-        Create EPG record
+    def append_program(self, program: EPGProgramEntry) -> None:
+        """ Append EPG program entry to the channel """
 
-        TODO: rewrite with XML processor
-        """
+        self.program.append(program)
 
-        return_entry = f'<channel id="{self.channel_id}">\n'
-        for key, value in self.__dict__.items():
+    def extend_programs(self, programs: Iterable[EPGProgramEntry]) -> None:
+        """ Append EPG program entries to the channel in bulk """
+
+        self.program.extend(programs)
+
+    def iter_epg_entry(self,
+            time_formatter: XMLTVTimeFormatter=None) -> Iterator[str]:
+        """ Generate EPG record chunk by chunk """
+
+        time_formatter = time_formatter or LOCAL_TIME_FORMATTER
+        language = html.escape(self.language)
+
+        yield (f'<channel id="{html.escape(self.channel_id)}">\n'
+               f'<display-name lang="{language}">'
+               f'{html.escape(self.display_name)}</display-name>\n'
+               f'<icon src="{html.escape(self.icon)}"/>\n'
+               '</channel>\n')
+
+        starts = time_formatter.format_many(
+                                [program.start for program in self.program])
+        stops = time_formatter.format_many(
+                                [program.stop for program in self.program])
+
+        for program, start, stop in zip(self.program, starts, stops):
+            channel_id = html.escape(program.channel_id)
+            title = html.escape(program.title)
+            desc = html.escape(program.desc)
+            icon = html.escape(program.icon or '')
+
+            yield (f'<programme start="{start}" '
+                   f'stop="{stop}" '
+                   f'channel="{channel_id}">\n'
+                   f'<title lang="{language}">{title}</title>\n'
+                   f'<desc lang="{language}">{desc}</desc>\n'
+                   f'<icon src="{icon}"/>\n')
+
+            yield '\n'.join(
+                f'<category lang="{language}">{html.escape(cat)}</category>'
+                for cat in program.category or ())
 
-            if (isinstance(value, int | str)
-                and key not in ('channel_id', 'language', 'program')):
-
-                key_normalized = key.replace("_", "-")
-                value_escaped = html.escape(value)
-                language = self.language
-
-                if key == 'icon':
-                    return_entry+=f'<{key_normalized} src="{value_escaped}"/>\n'
-                else:
-                    return_entry+=f'<{key_normalized} lang="{language}">' \
-                                    f'{value_escaped}</{key_normalized}>\n'
-
-        return_entry += '</channel>\n'
-
-        for program in self.program:
-            start = datetime.fromtimestamp(
-                    program['start']).astimezone().strftime('%Y%m%d%H%M%S %z')
-            stop = datetime.fromtimestamp(
-                    program['stop']).astimezone().strftime('%Y%m%d%H%M%S %z')
-            channel_id = program['channel_id']
-            title = html.escape(program['title'])
-            desc = html.escape(program['desc'])
-            lang = self.language
-            icon = program['icon']
-
-            return_entry += f'<programme start="{start}" ' \
-                            f'stop="{stop}" ' \
-                            f'channel="{channel_id}">\n' \
-                            f'<title lang="{lang}">{title}</title>\n' \
-                            f'<desc lang="{lang}">{desc}</desc>\n' \
-                            f'<icon src="{icon}"/>\n'
-
-            return_entry += '\n'.join(map(
-                lambda cat: f'<category lang="{lang}">{cat}</category>',
-                                                        program['category']))
-            return_entry += '\n</programme>\n'
+            yield '\n</programme>\n'
 
         self._lgr.logger.debug(
             'Generate XMLTV entry for channel `%s`', self.display_name)
 
-        return return_entry
+    def write_epg_entry(self, output: TextIO=None,
+                        time_formatter: XMLTVTimeFormatter=None) -> None:
+        """ Write EPG record to the file-like object """
+
+        output.writelines(self.iter_epg_entry(time_formatter))
+
+    def make_epg_entry(self,
+                        time_formatter: XMLTVTimeFormatter=None) -> str:
+        """ Create EPG record """
+
+        return ''.join(self.iter_epg_entry(time_formatter))
 
 class EPGListing:
     """ Class to generate XMLTV listing from EPG channel and program entries """
@@ -201,25 +336,27 @@ class EPGListing:
     def __init__(self,
                 generator_name: str = 'dummy',
                 generator_url: str = 'https://localhost',
+                utc: bool=False,
                 loglevel: int=20):
 
         self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
-        self._epg_channels: list[EPGChannelEntry] = []
+        self._epg_channels: dict[str, EPGChannelEntry] = {}
         self._generator_name: str = generator_name
         self._generator_url: str = generator_url
+        self._time_formatter = XMLTVTimeFormatter(utc=utc)
 
     def __str__(self) -> str:
         """ Human readable print of the current class """
 
         return json.dumps(
-            [ch.make_dict() for ch in self._epg_channels],
+            [ch.make_dict() for ch in self._epg_channels.values()],
             ensure_ascii=False, indent=4
         )
 
     def append_epg_channel(self, channel: EPGChannelEntry) -> None:
         """ Append EPG channel entry to existing list """
 
-        self._epg_channels.append(channel)
+        self._epg_channels[channel.channel_id] = channel
         self._lgr.logger.info('Add EPG channel `%s`', channel.display_name)
         self._lgr.logger.debug('%s', channel)
 
@@ -228,31 +365,112 @@ class EPGListing:
                     program: EPGProgramEntry) -> None:
         """ Append EPG program entry to existing EPG channel """
 
-        for chnl in self._epg_channels:
-            if channel.get_attribute('channel_id') == chnl.channel_id:
-                channel.program.append(asdict(program))
+        chnl = self._epg_channels.get(channel.get_attribute('channel_id'))
 
-    def make_epg_listing(self) -> dict:
-        """
-        Create EPG listing
+        if chnl is not None:
+            chnl.append_program(program)
 
-        TODO: rewrite with XML processor
-        """
+    def extend_programs(self, channel_id: str=None,
+                        programs: Iterable[EPGProgramEntry]=None) -> None:
+        """ Append EPG program entries to existing EPG channel in bulk """
 
-        date_gen = datetime.now().astimezone().strftime('%Y%m%d%H%M%S %z')
-        return_listing = ('<?xml version="1.0" encoding="utf-8" ?>\n'
+        chnl = self._epg_channels.get(channel_id)
+
+        if chnl is None:
+            self._lgr.logger.warning(
+                'Cannot add EPG programs to unknown channel `%s`', channel_id)
+        else:
+            chnl.extend_programs(programs)
+
+    def make_epg_header(self) -> str:
+        """ Create EPG listing header to prepend channel entries with """
+
+        date_gen = self._time_formatter.format(time.time())
+
+        return ('<?xml version="1.0" encoding="utf-8" ?>\n'
             '<!DOCTYPE tv SYSTEM "https://raw.githubusercontent.com/XMLTV/xmltv'
             '/refs/heads/master/xmltv.dtd">\n'
             f'<tv date="{date_gen}" '
             f'generator-info-name="{self._generator_name}" '
             f'generator-info-url="{self._generator_url}">\n')
 
-        for channel in self._epg_channels:
-            return_listing += channel.make_epg_entry()
+    def make_epg_footer(self) -> str:
+        """ Create EPG listing footer to append after channel entries """
+
+        return '</tv>'
+
+    def write_epg_channel(self, output: TextIO=None,
+                            channel: EPGChannelEntry=None) -> None:
+        """ Write EPG channel entry to the file-like object as it comes """
+
+        channel.write_epg_entry(output, self._time_formatter)
+
+    def get_counts(self) -> tuple[int, int]:
+        """ Return number of EPG channels and EPG programs """
+
+        return (len(self._epg_channels), sum(
+            len(channel.program) for channel in self._epg_channels.values()))
+
+    def _iter_epg_body(self) -> Iterator[str]:
+        """ Generate EPG channel entries and footer chunk by chunk """
+
+        for channel in self._epg_channels.values():
+            yield from channel.iter_epg_entry(self._time_formatter)
+
+        yield self.make_epg_footer()
+
+    def iter_epg_listing(self, digest: 'hashlib._Hash'=None) -> Iterator[str]:
+        """
+        Generate EPG listing chunk by chunk. The digest is updated with all
+        but the header, which carries the generation time, so it only
+        changes with the content
+        """
+
+        yield self.make_epg_header()
+
+        if digest is None:
+            yield from self._iter_epg_body()
+            return
+
+        for chunk in self._iter_epg_body():
+            digest.update(chunk.encode('utf8'))
+            yield chunk
+
+    def write_epg_listing(self, file: str=None, plain_copy: bool=False,
+                            digest: 'hashlib._Hash'=None,
+                            skip_unchanged: bool=False,
+                            wrap_chunks: Callable[[Iterator[str]],
+                                                    Iterable[str]]=None
+                            ) -> bool:
+        """
+        Write EPG listing to the file, replacing it atomically. Compressed
+        file may be written along with its plain copy. With skip unchanged
+        set, the file is left as is when only the generation date differs.
+        Rendered chunks are passed through wrap_chunks if set, e.g. to time
+        rendering. Return whether the file changed
+        """
+
+        chunks = self.iter_epg_listing(digest)
+        if wrap_chunks is not None:
+            chunks = wrap_chunks(chunks)
+
+        changed = write_output(file=file,
+                                chunks=chunks,
+                                plain_copy=plain_copy,
+                                skip_unchanged=skip_unchanged,
+                                volatile=XMLTV_VOLATILE)
+
+        if changed:
+            self._lgr.logger.debug('Write XMLTV listing to %s', file)
+        else:
+            self._lgr.logger.debug('XMLTV listing %s is unchanged', file)
+
+        return changed
 
-        return_listing += '</tv>'
+    def make_epg_listing(self) -> str:
+        """ Create EPG listing """
 
-        return return_listing
+        return ''.join(self.iter_epg_listing())
 
 if __name__ == '__main__':
 
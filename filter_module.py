@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Filter Module """
+
+import re
+import sys
+from logger_module import Logger
+
+# Kinds of channel selection rules, rules are set as kind:value
+FILTER_KINDS = ('id', 'number', 'title', 'genre')
+
+class ChannelFilter:
+    """
+    Select channels by include and exclude rules
+
+    Rules are id:<channel id>, number:<number or range like 1-20, 100- or
+    -10>, title:<regular expression searched in the title> and
+    genre:<genre, case insensitive>. A channel is selected if it matches any
+    include rule, or there are none, and does not match any exclude rule
+    """
+
+    def __init__(self, include: list[str]=None,
+                    exclude: list[str]=None) -> None:
+
+        self._include = [self._parse_rule(rule) for rule in include or ()]
+        self._exclude = [self._parse_rule(rule) for rule in exclude or ()]
+
+    def __bool__(self) -> bool:
+        return bool(self._include or self._exclude)
+
+    @staticmethod
+    def _parse_rule(rule: str=None) -> tuple:
+        """ Parse the rule into (kind, value), raise ValueError if invalid """
+
+        kind, separator, value = rule.partition(':')
+
+        if not separator or kind not in FILTER_KINDS or not value:
+            raise ValueError(f'invalid channel filter `{rule}`, expected '
+                             f'one of {", ".join(FILTER_KINDS)} as '
+                             f'kind:value')
+
+        if kind == 'number':
+            first, separator, last = value.partition('-')
+            try:
+                first = int(first) if first else 0
+                last = (int(last) if last else sys.maxsize) \
+                    if separator else first
+            except ValueError:
+                raise ValueError(f'invalid channel number range `{value}`') \
+                    from None
+            return kind, (first, last)
+
+        if kind == 'title':
+            try:
+                return kind, re.compile(value)
+            except re.error as err:
+                raise ValueError(f'invalid channel title expression '
+                                 f'`{value}`: {err}') from None
+
+        if kind == 'genre':
+            return kind, value.casefold()
+
+        return kind, value
+
+    @staticmethod
+    def _match_rule(rule: tuple=None, channel_id: str=None, number: int=None,
+                    title: str=None, genres: list[str]=None) -> bool:
+        """ Check the channel matches the rule """
+
+        kind, value = rule
+
+        if kind == 'id':
+            return channel_id == value
+        if kind == 'number':
+            return value[0] <= number <= value[1]
+        if kind == 'title':
+            return value.search(title) is not None
+        return any(genre.casefold() == value for genre in genres or ())
+
+    def is_selected(self, channel_id: str=None, number: int=None,
+                    title: str=None, genres: list[str]=None) -> bool:
+        """ Check the channel is selected by the rules """
+
+        fields = (channel_id, number, title, genres)
+
+        if self._include and not any(self._match_rule(rule, *fields)
+                                        for rule in self._include):
+            return False
+
+        return not any(self._match_rule(rule, *fields)
+                        for rule in self._exclude)
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
@@ -3,19 +3,26 @@
 
 import re
 import sys
+import atexit
 import logging
+import logging.handlers
+import queue
 
 class SensitiveDataFormatter(logging.Formatter):
     """ Logging Sensitive Data Formatter """
 
-    @staticmethod
-    def _filter(message: str=None):
-        filters = [
-            [r"'password': '.+?'", "'password': '*****'"],
-            [r'password=.+?', 'password=*****']
-        ]
-        for filter_pattern in filters:
-            message = re.sub(filter_pattern[0], filter_pattern[1], message)
+    _filters = (
+        (re.compile(r"'password': '.+?'"), "'password': '*****'"),
+        (re.compile(r'password=[^&\s]+'), 'password=*****')
+    )
+
+    @classmethod
+    def _filter(cls, message: str=None):
+        if 'password' not in message:
+            return message
+
+        for filter_pattern, replacement in cls._filters:
+            message = filter_pattern.sub(replacement, message)
         return message
 
     def format(self, record: str=''):
@@ -23,19 +30,47 @@ class SensitiveDataFormatter(logging.Formatter):
         return self._filter(original)
 
 class Logger:
-    """ Logger class """
+    """
+    Logger class
+
+    All named loggers share a single queue handler, the records are written
+    to stdout by a background listener thread, so logging never blocks
+    the callers on console I/O
+    """
+
+    _queue_handler: logging.handlers.QueueHandler = None
 
     def __init__(self, loglevel: int = 20, classname: str=None):
         self.logger = logging.getLogger(classname)
-        self._console_handler = logging.StreamHandler(sys.stdout)
-        self._console_handler.setFormatter(
+
+        if self._queue_handler is None:
+            Logger._install_handler()
+
+        if self._queue_handler not in self.logger.handlers:
+            self.logger.addHandler(self._queue_handler)
+
+        self.logger.setLevel(loglevel)
+
+    @classmethod
+    def _install_handler(cls) -> None:
+        """ Create the queue handler and start the console listener once """
+
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(
             SensitiveDataFormatter(
                 '[%(asctime)s] %(levelname)s %(module)s.py::'
                 '%(name)s::%(funcName)s(): %(message)s',
             )
         )
-        self.logger.addHandler(self._console_handler)
-        self.logger.setLevel(loglevel)
+
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(
+                                log_queue, console_handler,
+                                respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+        cls._queue_handler = logging.handlers.QueueHandler(log_queue)
 
 if __name__ == '__main__':
 
@@ -3,8 +3,10 @@
 
 import json
 import sys
+from collections.abc import Callable, Iterable, Iterator
 from dataclasses import dataclass
 from logger_module import Logger
+from output_module import write_output
 
 @dataclass
 class M3UChannelEntry:
@@ -117,16 +119,50 @@ class M3UPlaylist:
         self._lgr.logger.info('Add M3U channel `%s`', channel.title)
         self._lgr.logger.debug('%s', channel)
 
-    def make_m3u_playlist(self) -> dict:
-        """ Create M3U playlist """
+    def make_m3u_header(self) -> str:
+        """ Create M3U playlist header to prepend channel entries with """
+
+        return '#EXTM3U\n'
+
+    def iter_m3u_playlist(self) -> Iterator[str]:
+        """ Generate M3U playlist entry by entry """
 
         self._lgr.logger.debug('Generate M3U playlist')
 
-        return_playlist = '#EXTM3U\n'
+        yield self.make_m3u_header()
         for channel in self._m3u_channels:
-            return_playlist += channel.make_m3u_entry()
+            yield channel.make_m3u_entry()
+
+    def make_m3u_playlist(self) -> dict:
+        """ Create M3U playlist """
 
-        return return_playlist
+        return ''.join(self.iter_m3u_playlist())
+
+    def write_m3u_playlist(self, file: str=None,
+                            skip_unchanged: bool=False,
+                            wrap_chunks: Callable[[Iterator[str]],
+                                                    Iterable[str]]=None
+                            ) -> bool:
+        """
+        Write M3U playlist to the file, replacing it atomically. With skip
+        unchanged set, the file is left as is when the content is the same.
+        Rendered chunks are passed through wrap_chunks if set, e.g. to time
+        rendering. Return whether the file changed
+        """
+
+        chunks = self.iter_m3u_playlist()
+        if wrap_chunks is not None:
+            chunks = wrap_chunks(chunks)
+
+        changed = write_output(file=file, chunks=chunks,
+                                skip_unchanged=skip_unchanged)
+
+        if changed:
+            self._lgr.logger.debug('Write M3U playlist to %s', file)
+        else:
+            self._lgr.logger.debug('M3U playlist %s is unchanged', file)
+
+        return changed
 
 if __name__ == '__main__':
 
@@ -2,17 +2,43 @@
 """ Smotreshka LiveTV Ripper """
 
 import argparse
+import atexit
+import hashlib
+import json
+import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from contextlib import ExitStack, nullcontext
 from pathlib import Path
 from logger_module import Logger
 from m3u_module import M3UChannelEntry, M3UPlaylist
-from epg_module import EPGChannelEntry, EPGProgramEntry, EPGListing
+from epg_module import XMLTV_VOLATILE, EPGChannelEntry, EPGListing
+from batch_module import ACCOUNT_FILE_KEYS, EPGShare, load_accounts
+from filter_module import ChannelFilter
+from cache_module import DEFAULT_TTLS, ResponseCache
+from metrics_module import RunMetrics
+from output_module import (atomic_open, get_manifest_file, get_plain_file,
+                            get_shard_files, open_output, open_unchanged)
+from profile_module import RunProfiler
+from requests.adapters import HTTPAdapter
+from scheduler_module import RequestScheduler
 from smotreshka_module import Smotreshka
+from server_module import LiveTVServer
+from state_module import EPGState
 
 GENERATOR_VERSION='0.1'
 GENERATOR_NAME=f'Smotreshka-Live-TV-Ripper-v{GENERATOR_VERSION}'
 GENERATOR_URL='https://github.com/freefd/smotreshka-livetv-ripper'
 
+# Exit code of --skip-unchanged runs which left all output files as they were
+EXIT_UNCHANGED=3
+
+# Genre shard of channels without genres
+UNGROUPED_SHARD='other'
+
 def get_args() -> dict:
     """ Parse CLI arguments """
 
@@ -22,15 +48,34 @@ def get_args() -> dict:
                 '-u', '--username',
                 type=str,
                 default=None,
-                help='User name to login. Default: not set',
-                required=True
+                help='User name to login, required unless --batch is set. '
+                     'Default: not set'
             )
     args_parser.add_argument(
                 '-p', '--password',
                 type=str,
                 default=None,
-                help='Password to login. Default: not set',
-                required=True
+                help='Password to login, required unless --batch is set. '
+                     'Default: not set'
+            )
+    args_parser.add_argument(
+                '--session-file',
+                type=str,
+                default=None,
+                help='File to keep session cookies in between runs, login '
+                     'is only done when the session is rejected. '
+                     'Default: not set, login on every run'
+            )
+    args_parser.add_argument(
+                '--batch',
+                type=str,
+                default=None,
+                metavar='CONFIG',
+                help='JSON file listing accounts to run concurrently over '
+                     'shared connections, EPG of a channel is collected once '
+                     'for all of them. Accounts set their own credentials, '
+                     'output files and channels, other options apply to '
+                     'all. Default: not set'
             )
     args_parser.add_argument(
                 '-m3u', '--m3u-output',
@@ -42,7 +87,40 @@ def get_args() -> dict:
                 '-xmltv', '--xmltv-output',
                 type=str,
                 default='smotreshka.xmltv.xml',
-                help='Generated XMLTV file path. Default: smotreshka.xmltv.xml'
+                help='Generated XMLTV file path, compressed on the fly with '
+                     '.gz or .xz suffix. Default: smotreshka.xmltv.xml'
+            )
+    args_parser.add_argument(
+                '--xmltv-plain',
+                help='Keep uncompressed copy of compressed XMLTV file next to '
+                     'it without the compression suffix. Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '--xmltv-utc',
+                help='Write XMLTV times in UTC instead of the local time zone. '
+                     'Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '--skip-unchanged',
+                help='Leave output files as they are when their content is '
+                     'the same, the XMLTV generation date aside, and exit '
+                     f'with code {EXIT_UNCHANGED} if none changed. '
+                     'Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '--xmltv-shard',
+                type=str,
+                choices=['genre', 'day'],
+                default=None,
+                help='Split XMLTV listing into files per channel genre or per '
+                     'day of program start, named after the XMLTV file and '
+                     'listed in its .manifest.json. Default: not set'
             )
     args_parser.add_argument(
                 '-l', '--limit',
@@ -50,6 +128,120 @@ def get_args() -> dict:
                 default=0,
                 help='Limit the number of channels for processing. Default: 0'
             )
+    args_parser.add_argument(
+                '--include-channel',
+                type=str,
+                action='append',
+                default=[],
+                metavar='RULE',
+                help='Process only channels matching the rule, can be set '
+                     'multiple times. Rules: id:ID, number:FIRST-LAST, '
+                     'title:REGEX, genre:GENRE. Default: all channels'
+            )
+    args_parser.add_argument(
+                '--exclude-channel',
+                type=str,
+                action='append',
+                default=[],
+                metavar='RULE',
+                help='Skip channels matching the rule, can be set multiple '
+                     'times. Rules as for --include-channel. Default: not set'
+            )
+    args_parser.add_argument(
+                '-c', '--concurrency',
+                type=int,
+                default=8,
+                help='Number of parallel requests to Smotreshka. Default: 8'
+            )
+    args_parser.add_argument(
+                '--rate-limit',
+                type=float,
+                default=0,
+                help='Maximum number of requests per second to Smotreshka. '
+                     'Default: 0, not limited'
+            )
+    args_parser.add_argument(
+                '--retries',
+                type=int,
+                default=3,
+                help='Number of retries of failed requests to Smotreshka. '
+                     'Default: 3'
+            )
+    args_parser.add_argument(
+                '--timeout',
+                type=float,
+                default=60,
+                help='Timeout of requests to Smotreshka in seconds. Default: 60'
+            )
+    args_parser.add_argument(
+                '--hedge-percentile',
+                type=float,
+                default=0,
+                help='Duplicate media stream requests slower than this '
+                     'percentile of observed latencies, the first response '
+                     'wins. Default: 0, not hedged'
+            )
+    args_parser.add_argument(
+                '--hedge-budget',
+                type=float,
+                default=10,
+                help='Maximum share of duplicated requests in percent. '
+                     'Default: 10'
+            )
+    args_parser.add_argument(
+                '--cache-dir',
+                type=str,
+                default=None,
+                help='Directory to cache Smotreshka responses in. '
+                     'Default: not set, cache is disabled'
+            )
+    args_parser.add_argument(
+                '--cache-size',
+                type=int,
+                default=256,
+                help='Maximum size of cached responses in MiB. Default: 256'
+            )
+    args_parser.add_argument(
+                '--cache-ttl',
+                type=str,
+                action='append',
+                default=[],
+                metavar='ENDPOINT=SECONDS',
+                help='Time to live of cached responses of the endpoint, '
+                     'one of: ' + ', '.join(DEFAULT_TTLS) + '. Can be set '
+                     'multiple times. Default: ' + ', '.join(
+                        f'{name}={ttl}' for name, ttl in DEFAULT_TTLS.items())
+            )
+    args_parser.add_argument(
+                '--epg-state',
+                type=str,
+                default=None,
+                help='State file to refresh EPG incrementally, only channels '
+                     'with EPG ending within the horizon or changed channels '
+                     'are collected again. Default: not set, collect full EPG'
+            )
+    args_parser.add_argument(
+                '--epg-horizon',
+                type=int,
+                default=24,
+                help='EPG refresh horizon in hours, capped at the end of '
+                     'the --epg-days window. Default: 24'
+            )
+    args_parser.add_argument(
+                '--epg-from',
+                type=str,
+                default=None,
+                help='Keep EPG programs ending after this ISO 8601 date or '
+                     'time, local time zone unless set. Default: not set, '
+                     'now with --epg-days'
+            )
+    args_parser.add_argument(
+                '--epg-days',
+                type=float,
+                default=None,
+                help='Keep EPG programs starting within this number of days '
+                     'from --epg-from. Default: not set, all programs'
+            )
     args_parser.add_argument(
                 '-m', '--mode',
                 type=str,
@@ -57,6 +249,88 @@ def get_args() -> dict:
                 choices=['all', 'epg', 'm3u'],
                 default='all'
             )
+    args_parser.add_argument(
+                '-P', '--pipeline',
+                help='Write output files channel by channel while collecting '
+                     'data from Smotreshka. Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '-S', '--serve',
+                help='Serve M3U playlist and XMLTV listing over HTTP from '
+                     'memory instead of writing files, refreshing them in '
+                     'background. Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '--listen',
+                type=str,
+                default='127.0.0.1:8080',
+                help='Address to serve on in the server mode. '
+                     'Default: 127.0.0.1:8080'
+            )
+    args_parser.add_argument(
+                '--refresh-interval',
+                type=int,
+                default=60,
+                help='Refresh interval in minutes in the server mode. '
+                     'Default: 60'
+            )
+    args_parser.add_argument(
+                '--lazy-streams',
+                help='Point M3U playlist entries to the server, which resolves '
+                     'media streams only when a channel is tuned in. Requires '
+                     'the server mode. Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '--public-url',
+                type=str,
+                default=None,
+                help='Server URL used in M3U playlist entries with lazy '
+                     'streams. Default: http://LISTEN'
+            )
+    args_parser.add_argument(
+                '--stream-ttl',
+                type=int,
+                default=300,
+                help='Seconds to reuse a lazily resolved media stream URL for. '
+                     'Default: 300'
+            )
+    args_parser.add_argument(
+                '--metrics-out',
+                type=str,
+                action='append',
+                default=[],
+                help='File to write run metrics to when the run ends, and '
+                     'after each refresh with --serve, in Prometheus text '
+                     'format for .prom files and JSON otherwise. Can be set '
+                     'multiple times. Default: not set'
+            )
+    args_parser.add_argument(
+                '--profile',
+                type=str,
+                default=None,
+                help='File to dump cProfile statistics of the run to, a '
+                     'summary per stage is logged. Default: not set'
+            )
+    args_parser.add_argument(
+                '--trace-alloc',
+                help='Log peak traced memory and top allocation sites per '
+                     'stage. Default: false',
+                action='store_true',
+                default=False
+            )
+    args_parser.add_argument(
+                '--profile-top',
+                type=int,
+                default=20,
+                help='Number of top functions and allocation sites to log. '
+                     'Default: 20'
+            )
     args_parser.add_argument(
                 '-o', '--overwrite',
                 help='Allow to overwrite existing output files. Default: false',
@@ -75,21 +349,377 @@ def get_args() -> dict:
 
     args_parsed.verbose = 10 if args_parsed.verbose<=0 else args_parsed.verbose
 
+    cache_ttls = {}
+    for cache_ttl in args_parsed.cache_ttl:
+        endpoint, _, ttl = cache_ttl.partition('=')
+        if endpoint not in DEFAULT_TTLS or not ttl.isdigit():
+            args_parser.error(f'invalid --cache-ttl value: {cache_ttl}')
+        cache_ttls[endpoint] = int(ttl)
+    args_parsed.cache_ttl = cache_ttls
+
+    try:
+        args_parsed.channel_filter = ChannelFilter(
+                                        include=args_parsed.include_channel,
+                                        exclude=args_parsed.exclude_channel)
+    except ValueError as err:
+        args_parser.error(str(err))
+
+    if args_parsed.epg_from is not None:
+        try:
+            args_parsed.epg_from = datetime.fromisoformat(
+                                    args_parsed.epg_from).timestamp()
+        except ValueError:
+            args_parser.error(
+                f'invalid --epg-from value: {args_parsed.epg_from}')
+
+    if args_parsed.epg_days is not None and args_parsed.epg_days <= 0:
+        args_parser.error('--epg-days must be positive')
+
+    listen_host, _, listen_port = args_parsed.listen.rpartition(':')
+    if not listen_host or not listen_port.isdigit():
+        args_parser.error(f'invalid --listen value: {args_parsed.listen}')
+    args_parsed.listen = (listen_host.strip('[]'), int(listen_port))
+
+    if args_parsed.lazy_streams and not args_parsed.serve:
+        args_parser.error('--lazy-streams requires --serve')
+
+    if args_parsed.xmltv_shard is not None and (args_parsed.pipeline
+                                                or args_parsed.serve):
+        args_parser.error('--xmltv-shard cannot be used with --pipeline '
+                          'or --serve')
+
+    if args_parsed.public_url is None:
+        args_parsed.public_url = f'http://{listen_host}:{listen_port}'
+    args_parsed.public_url = args_parsed.public_url.rstrip('/')
+
+    # Accounts copy the options, they must be validated and normalised
+    args_parsed.accounts = []
+    if args_parsed.batch is not None:
+        if args_parsed.serve:
+            args_parser.error('--batch cannot be used with --serve')
+
+        try:
+            for account in load_accounts(args_parsed.batch):
+                account_args = argparse.Namespace(**vars(args_parsed)
+                                                    | account)
+                account_args.channel_filter = ChannelFilter(
+                                        include=account_args.include_channel,
+                                        exclude=account_args.exclude_channel)
+                if account_args.xmltv_shard is not None \
+                    and account_args.pipeline:
+                    raise ValueError('--xmltv-shard cannot be used with '
+                                     '--pipeline')
+                args_parsed.accounts.append(account_args)
+        except ValueError as err:
+            args_parser.error(str(err))
+
+        for key, modes in ACCOUNT_FILE_KEYS.items():
+            files = [vars(account_args)[key]
+                        for account_args in args_parsed.accounts
+                        if vars(account_args)[key] is not None
+                        and account_args.mode in modes]
+            if len(files) != len(set(files)):
+                args_parser.error(f'accounts of --batch must not share '
+                                  f'{key} files')
+
+    elif args_parsed.username is None or args_parsed.password is None:
+        args_parser.error('the following arguments are required: '
+                          '-u/--username, -p/--password')
+
     return args_parsed
 
-if __name__ == '__main__':
+def make_epg_channel(channel_id: str, channel_data: dict) -> EPGChannelEntry:
+    """ Create EPG channel entry from Smotreshka channel data """
 
-    args = get_args()
-    lgr  = Logger(loglevel=args.verbose, classname=__name__)
+    return EPGChannelEntry(
+            channel_id=channel_id,
+            display_name=channel_data['title'],
+            icon=channel_data['logo'],
+            language=channel_data['language']
+        )
 
-    if (Path(args.xmltv_output).exists()
-        and not args.overwrite
-        and args.mode in ('all', 'epg')):
-        lgr.logger.critical(
-            'Target XMLTV listing file %s already exists', args.xmltv_output)
+def make_m3u_channel(channel_id: str, channel_data: dict) -> M3UChannelEntry:
+    """ Create M3U channel entry from Smotreshka channel data """
 
-        # sysexits.h: EX_CANTCREAT
-        sys.exit(73)
+    return M3UChannelEntry(
+            title=channel_data['title'],
+            url=channel_data['url'],
+            group_title=channel_data['groups'],
+            tvg_chno=channel_data['number'],
+            tvg_id=channel_id,
+            tvg_logo=channel_data['logo'],
+            tvg_language=channel_data['language']
+        )
+
+def build_epg_listing(smotreshka_channels: dict,
+                        args: argparse.Namespace) -> EPGListing:
+    """ Create EPG listing from collected Smotreshka channels """
+
+    epg_listing_obj = EPGListing(
+            generator_name = GENERATOR_NAME,
+            generator_url = GENERATOR_URL,
+            utc = args.xmltv_utc,
+            loglevel = args.verbose
+        )
+
+    for channel_id, channel_data in smotreshka_channels.items():
+        epg_channel = make_epg_channel(channel_id, channel_data)
+        epg_listing_obj.append_epg_channel(epg_channel)
+        epg_listing_obj.extend_programs(
+                channel_id, channel_data.get('program', []))
+
+    return epg_listing_obj
+
+def build_m3u_playlist(smotreshka_channels: dict,
+                        loglevel: int=20) -> M3UPlaylist:
+    """ Create M3U playlist from collected Smotreshka channels """
+
+    m3u_playlist_obj = M3UPlaylist(loglevel=loglevel)
+
+    for channel_id, channel_data in smotreshka_channels.items():
+        # Channels without collected media stream are reported by Smotreshka
+        if 'url' in channel_data:
+            m3u_playlist_obj.append_m3u_channel(
+                make_m3u_channel(channel_id, channel_data))
+
+    return m3u_playlist_obj
+
+def build_epg_shards(smotreshka_channels: dict,
+                        args: argparse.Namespace) -> dict[str, EPGListing]:
+    """
+    Create EPG listings per channel genre, a channel goes into each of its
+    genres or the fallback shard if it has none, or per day of program
+    start, a channel goes into each day it has programs on
+    """
+
+    shards: dict[str, EPGListing] = {}
+    time_zone = timezone.utc if args.xmltv_utc else None
+
+    def get_shard(key: str) -> EPGListing:
+        """ Return EPG listing of the shard, create it if missing """
+
+        if key not in shards:
+            shards[key] = EPGListing(
+                    generator_name = GENERATOR_NAME,
+                    generator_url = GENERATOR_URL,
+                    utc = args.xmltv_utc,
+                    loglevel = args.verbose
+                )
+        return shards[key]
+
+    for channel_id, channel_data in smotreshka_channels.items():
+        programs = channel_data.get('program', [])
+
+        if args.xmltv_shard == 'genre':
+            shard_programs = {genre: programs for genre in
+                                channel_data['groups'] or (UNGROUPED_SHARD,)}
+        else:
+            shard_programs = {}
+            for program in programs:
+                shard_programs.setdefault(datetime.fromtimestamp(
+                    program.start, time_zone).date().isoformat(), []).append(
+                                                                    program)
+
+        for key, key_programs in shard_programs.items():
+            shard = get_shard(key)
+            shard.append_epg_channel(make_epg_channel(channel_id, channel_data))
+            shard.extend_programs(channel_id, key_programs)
+
+    return dict(sorted(shards.items()))
+
+def write_epg_shards(shards: dict[str, EPGListing],
+                        args: argparse.Namespace,
+                        lgr: Logger,
+                        metrics: RunMetrics=None) -> tuple[Path, bool]:
+    """
+    Write EPG listing shards in parallel and the manifest listing them with
+    content hashes, so clients only download changed shards. The hash
+    covers the uncompressed listing without the header, which carries the
+    generation date, so it is not the hash of the file. Shards of the
+    previous manifest which are gone are removed. Return the manifest path
+    and whether any file changed
+    """
+
+    metrics = metrics or RunMetrics(loglevel=args.verbose)
+    manifest_file = get_manifest_file(args.xmltv_output)
+    shard_files = get_shard_files(args.xmltv_output, shards)
+
+    def write_shard(key: str, shard: EPGListing) -> dict:
+        """ Write the shard and return its manifest entry """
+
+        shard_file = shard_files[key]
+        digest = hashlib.sha256()
+        with metrics.stage('file_write'):
+            changed = shard.write_epg_listing(shard_file,
+                                plain_copy=args.xmltv_plain,
+                                digest=digest,
+                                skip_unchanged=args.skip_unchanged,
+                                wrap_chunks=partial(metrics.time_chunks,
+                                                    'xmltv_render',
+                                                    within='file_write'))
+        channels, programs = shard.get_counts()
+
+        return {
+            'key': key,
+            'file': shard_file.name,
+            'channels': channels,
+            'programs': programs,
+            'size': shard_file.stat().st_size,
+            'content_sha256': digest.hexdigest()
+        }, changed
+
+    with ThreadPoolExecutor(max_workers=min(len(shards) or 1,
+                                            os.cpu_count() or 1),
+                            thread_name_prefix='shard') as executor:
+        results = list(executor.map(write_shard, shards, shards.values()))
+
+    entries = [entry for entry, _ in results]
+    changed = any(shard_changed for _, shard_changed in results)
+
+    previous_manifest = {}
+    if manifest_file.exists():
+        try:
+            previous_manifest = json.loads(
+                                    manifest_file.read_text(encoding='utf8'))
+        except (OSError, ValueError) as err:
+            lgr.logger.warning('Cannot load previous XMLTV manifest %s: %s',
+                manifest_file, err)
+    previous_files = {entry['file']
+                        for entry in previous_manifest.get('shards', [])}
+
+    if (not args.skip_unchanged
+        or previous_manifest.get('shard') != args.xmltv_shard
+        or previous_manifest.get('shards') != entries):
+
+        with metrics.stage('file_write'), \
+                atomic_open(file=manifest_file) as manifest:
+            json.dump({
+                'generated': int(time.time()),
+                'shard': args.xmltv_shard,
+                'shards': entries
+            }, manifest, ensure_ascii=False, indent=4)
+        changed = True
+
+    for stale_file in previous_files - {entry['file'] for entry in entries}:
+        stale_path = manifest_file.with_name(stale_file)
+        lgr.logger.info('Remove stale XMLTV shard %s', stale_path)
+        stale_path.unlink(missing_ok=True)
+        if args.xmltv_plain and get_plain_file(stale_path) is not None:
+            get_plain_file(stale_path).unlink(missing_ok=True)
+
+    return manifest_file, changed
+
+def run_pipeline(smotreshka: Smotreshka, args: argparse.Namespace,
+                    metrics: RunMetrics=None) -> tuple[bool, bool]:
+    """
+    Write output files channel by channel as Smotreshka data arrives,
+    return whether the EPG XMLTV listing and the M3U playlist changed, an
+    output not written in the mode is unchanged
+    """
+
+    metrics = metrics or RunMetrics(loglevel=args.verbose)
+
+    with ExitStack() as stack:
+        xmltv_listing = m3u_playlist = None
+
+        if args.mode in ('all', 'epg'):
+            epg_listing_obj = EPGListing(
+                    generator_name = GENERATOR_NAME,
+                    generator_url = GENERATOR_URL,
+                    utc = args.xmltv_utc,
+                    loglevel = args.verbose
+                )
+            xmltv_listing = stack.enter_context(
+                                    open_unchanged(file=args.xmltv_output,
+                                                plain_copy=args.xmltv_plain,
+                                                volatile=XMLTV_VOLATILE)
+                                    if args.skip_unchanged else
+                                    open_output(file=args.xmltv_output,
+                                                plain_copy=args.xmltv_plain))
+            xmltv_listing.write(epg_listing_obj.make_epg_header())
+
+        if args.mode in ('all', 'm3u'):
+            m3u_playlist_obj = M3UPlaylist(loglevel=args.verbose)
+            m3u_playlist = stack.enter_context(
+                                    open_unchanged(file=args.m3u_output)
+                                    if args.skip_unchanged else
+                                    atomic_open(file=args.m3u_output))
+            m3u_playlist.write(m3u_playlist_obj.make_m3u_header())
+
+        for channel_id, channel_data in smotreshka.iter_channels():
+            if xmltv_listing is not None:
+                epg_channel = make_epg_channel(channel_id, channel_data)
+                epg_channel.extend_programs(channel_data.get('program', []))
+                epg_listing_obj.write_epg_channel(xmltv_listing, epg_channel)
+                metrics.count_emitted('xmltv_channels')
+                metrics.count_emitted('xmltv_programs',
+                                        len(epg_channel.program))
+
+            if m3u_playlist is not None and 'url' in channel_data:
+                m3u_playlist.write(
+                    make_m3u_channel(channel_id, channel_data).make_m3u_entry())
+                metrics.count_emitted('m3u_channels')
+
+        if xmltv_listing is not None:
+            xmltv_listing.write(epg_listing_obj.make_epg_footer())
+
+    return tuple(output is not None
+                    and (not args.skip_unchanged or output.changed)
+                    for output in (xmltv_listing, m3u_playlist))
+
+def render_documents(smotreshka: Smotreshka,
+                    args: argparse.Namespace,
+                    metrics: RunMetrics=None) -> dict[str, tuple[str, str]]:
+    """
+    Collect Smotreshka channels again and render documents to serve, then
+    write metrics accumulated since the start
+    """
+
+    metrics = metrics or RunMetrics(loglevel=args.verbose)
+
+    smotreshka.refresh()
+    smotreshka_channels = smotreshka.get_channels()
+    documents = {}
+
+    if args.mode in ('all', 'epg'):
+        with metrics.stage('xmltv_render'):
+            documents['/epg.xml'] = (
+                'application/xml; charset=utf-8',
+                build_epg_listing(smotreshka_channels,
+                                    args).make_epg_listing())
+
+    if args.mode in ('all', 'm3u'):
+        with metrics.stage('m3u_render'):
+            documents['/playlist.m3u'] = (
+                'audio/x-mpegurl; charset=utf-8',
+                build_m3u_playlist(smotreshka_channels,
+                                    args.verbose).make_m3u_playlist())
+
+    metrics.set_success()
+    for metrics_file in args.metrics_out:
+        metrics.write(metrics_file)
+
+    return documents
+
+def check_outputs(args: argparse.Namespace, lgr: Logger) -> None:
+    """ Exit if output files exist and must not be overwritten """
+
+    xmltv_files = [Path(args.xmltv_output)]
+    if args.xmltv_plain and get_plain_file(args.xmltv_output) is not None:
+        xmltv_files.append(get_plain_file(args.xmltv_output))
+    # Shards are only known after collection, their manifest stands for them
+    if args.xmltv_shard is not None:
+        xmltv_files = [get_manifest_file(args.xmltv_output)]
+
+    for xmltv_file in xmltv_files:
+        if (xmltv_file.exists()
+            and not args.overwrite
+            and args.mode in ('all', 'epg')):
+            lgr.logger.critical(
+                'Target XMLTV listing file %s already exists', xmltv_file)
+
+            # sysexits.h: EX_CANTCREAT
+            sys.exit(73)
 
     if (Path(args.m3u_output).exists()
         and not args.overwrite
@@ -100,80 +730,318 @@ if __name__ == '__main__':
         # sysexits.h: EX_CANTCREAT
         sys.exit(73)
 
+def log_xmltv_written(lgr: Logger, args: argparse.Namespace,
+                        changed: bool=True):
+    """ Log where the EPG XMLTV listing is and whether it was written """
 
-    smotreshka_channels = Smotreshka(
-                                username=args.username,
-                                password=args.password,
-                                limit=args.limit,
-                                mode=args.mode,
-                                loglevel=args.verbose
-                            ).get_channels()
+    if changed:
+        lgr.logger.info(
+            'Please find the generated EPG XMLTV listing\n\t- %s',
+            Path(args.xmltv_output).resolve())
+    else:
+        lgr.logger.info(
+            'EPG XMLTV listing is unchanged, not written\n\t- %s',
+            Path(args.xmltv_output).resolve())
 
-    if args.mode in ('all', 'epg'):
+def log_m3u_written(lgr: Logger, args: argparse.Namespace,
+                    changed: bool=True):
+    """ Log where the M3U playlist is and whether it was written """
 
-        epg_listing_obj = EPGListing(
-                generator_name = GENERATOR_NAME,
-                generator_url = GENERATOR_URL
-            )
+    if changed:
+        lgr.logger.info(
+            'Please find generated M3U playlist\n\t- %s',
+            Path(args.m3u_output).resolve())
+    else:
+        lgr.logger.info(
+            'M3U playlist is unchanged, not written\n\t- %s',
+            Path(args.m3u_output).resolve())
 
-        for channel_id, channel_data in smotreshka_channels.items():
-            epg_channel = EPGChannelEntry(
-                    channel_id=channel_id,
-                    display_name=channel_data['title'],
-                    icon=channel_data['logo'],
-                    language=channel_data['language']
-                )
+def write_outputs(smotreshka: Smotreshka, args: argparse.Namespace,
+                    lgr: Logger, metrics: RunMetrics,
+                    profiler: RunProfiler=None) -> bool:
+    """
+    Collect Smotreshka data if not yet done and write output files, return
+    whether any file changed
+    """
 
-            epg_listing_obj.append_epg_channel(epg_channel)
-
-            if 'program' in channel_data:
-                for program in channel_data['program']:
-                    epg_channel_program = EPGProgramEntry(
-                        channel_id=channel_id,
-                        category=channel_data['groups'],
-                        start=program['start'],
-                        stop=program['stop'],
-                        title=program['title'],
-                        desc=program['desc'],
-                        icon=program['icon']
-                    )
+    def profile(stage: str):
+        """ Profile the stage if the profiler is set """
+        return nullcontext() if profiler is None else profiler.stage(stage)
+
+    if args.pipeline:
+        with profile('pipeline'), metrics.stage('pipeline'):
+            xmltv_changed, m3u_changed = run_pipeline(smotreshka, args,
+                                                        metrics)
 
-                    epg_listing_obj.append_epg_program(
-                                            epg_channel, epg_channel_program)
+        if args.mode in ('all', 'epg'):
+            log_xmltv_written(lgr, args, xmltv_changed)
+        if args.mode in ('all', 'm3u'):
+            log_m3u_written(lgr, args, m3u_changed)
 
-        with open(
-            file=args.xmltv_output,
-            mode='w',
-            encoding='utf8'
-        ) as xmltv_listing:
-            xmltv_listing.write(epg_listing_obj.make_epg_listing())
-            lgr.logger.info(
-                'Please find the generated EPG XMLTV listing\n\t- %s',
-                Path(args.xmltv_output).resolve())
+        return xmltv_changed or m3u_changed
+
+    smotreshka_channels = smotreshka.get_channels()
+    changed = False
+
+    if args.mode in ('all', 'epg') and args.xmltv_shard is not None:
+
+        with profile('EPGListing'):
+            with metrics.stage('xmltv_render'):
+                epg_shards = build_epg_shards(smotreshka_channels, args)
+            # Shards are rendered while written, in parallel
+            manifest_file, shards_changed = write_epg_shards(
+                                                epg_shards, args, lgr, metrics)
+
+        metrics.count_emitted('xmltv_shards', len(epg_shards))
+        metrics.count_emitted('xmltv_channels', len(smotreshka_channels))
+        metrics.count_emitted('xmltv_programs', sum(
+                        len(channel_data.get('program', []))
+                        for channel_data in smotreshka_channels.values()))
+        changed |= shards_changed
+        lgr.logger.info(
+            'Please find the manifest of %d %s EPG XMLTV shards\n\t- %s',
+            len(epg_shards), 'generated' if shards_changed else 'unchanged',
+            manifest_file.resolve())
+
+    elif args.mode in ('all', 'epg'):
+
+        with profile('EPGListing'):
+            with metrics.stage('xmltv_render'):
+                epg_listing_obj = build_epg_listing(smotreshka_channels, args)
+            with metrics.stage('file_write'):
+                xmltv_changed = epg_listing_obj.write_epg_listing(
+                                    args.xmltv_output,
+                                    plain_copy=args.xmltv_plain,
+                                    skip_unchanged=args.skip_unchanged,
+                                    wrap_chunks=partial(metrics.time_chunks,
+                                                        'xmltv_render',
+                                                        within='file_write'))
+
+        metrics.count_emitted('xmltv_channels', len(smotreshka_channels))
+        metrics.count_emitted('xmltv_programs', sum(
+                        len(channel_data.get('program', []))
+                        for channel_data in smotreshka_channels.values()))
+        changed |= xmltv_changed
+        log_xmltv_written(lgr, args, xmltv_changed)
 
     if args.mode in ('all', 'm3u'):
 
-        m3u_playlist_obj = M3UPlaylist()
+        with profile('M3UPlaylist'):
+            with metrics.stage('m3u_render'):
+                m3u_playlist_obj = build_m3u_playlist(smotreshka_channels,
+                                                        args.verbose)
+            with metrics.stage('file_write'):
+                m3u_changed = m3u_playlist_obj.write_m3u_playlist(
+                                    args.m3u_output,
+                                    skip_unchanged=args.skip_unchanged,
+                                    wrap_chunks=partial(metrics.time_chunks,
+                                                        'm3u_render',
+                                                        within='file_write'))
 
-        for channel_id, channel_data in smotreshka_channels.items():
-            m3u_playlist_obj.append_m3u_channel(
-                M3UChannelEntry(
-                    title=channel_data['title'],
-                    url=channel_data['url'],
-                    group_title=channel_data['groups'],
-                    tvg_chno=channel_data['number'],
-                    tvg_id=channel_id,
-                    tvg_logo=channel_data['logo'],
-                    tvg_language=channel_data['language']
+        metrics.count_emitted('m3u_channels', sum(
+                        'url' in channel_data
+                        for channel_data in smotreshka_channels.values()))
+        changed |= m3u_changed
+        log_m3u_written(lgr, args, m3u_changed)
+
+    return changed
+
+def run_batch(args: argparse.Namespace, lgr: Logger,
+                metrics: RunMetrics) -> bool:
+    """
+    Run accounts of the batch concurrently, return whether any output file
+    changed. Requests of all accounts go through one connection pool and
+    one request scheduler, so the concurrency and rate limits apply to the
+    batch as a whole, as does the size bound of the response cache
+    """
+
+    pool_maxsize = args.concurrency * (2 if args.hedge_percentile > 0 else 1)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    scheduler = RequestScheduler(
+                    max_concurrency=max(1, args.concurrency),
+                    rate=args.rate_limit,
+                    retries=args.retries,
+                    hedge_percentile=args.hedge_percentile,
+                    hedge_budget=args.hedge_budget,
+                    loglevel=args.verbose
                 )
-            )
+    epg_share = EPGShare(loglevel=args.verbose)
+
+    response_cache = None
+    if args.cache_dir is not None:
+        response_cache = ResponseCache(
+                            directory=args.cache_dir,
+                            max_size=args.cache_size << 20,
+                            ttls=args.cache_ttl,
+                            loglevel=args.verbose
+                        )
+
+    def run_account(account_args: argparse.Namespace) -> bool:
+        """ Collect data of the account and write its output files """
+
+        epg_state = None
+        if (account_args.epg_state is not None
+            and account_args.mode in ('all', 'epg')):
+            epg_state = EPGState(
+                            file=account_args.epg_state,
+                            horizon=account_args.epg_horizon * 3600,
+                            loglevel=account_args.verbose
+                        )
+
+        smotreshka_obj = Smotreshka(
+                            username=account_args.username,
+                            password=account_args.password,
+                            limit=account_args.limit,
+                            mode=account_args.mode,
+                            concurrency=account_args.concurrency,
+                            prefetch=not account_args.pipeline,
+                            cache=response_cache.namespaced(
+                                                    account_args.username)
+                                if response_cache is not None else None,
+                            epg_state=epg_state,
+                            session_file=account_args.session_file,
+                            timeout=account_args.timeout,
+                            metrics=metrics,
+                            epg_from=account_args.epg_from,
+                            epg_days=account_args.epg_days,
+                            channel_filter=account_args.channel_filter,
+                            adapter=adapter,
+                            scheduler=scheduler,
+                            epg_share=epg_share,
+                            loglevel=account_args.verbose
+                        )
+
+        return write_outputs(smotreshka_obj, account_args, lgr, metrics)
+
+    with ThreadPoolExecutor(max_workers=len(args.accounts),
+                            thread_name_prefix='account') as executor:
+        futures = [executor.submit(run_account, account_args)
+                    for account_args in args.accounts]
+
+        return any([future.result() for future in futures])
+
+if __name__ == '__main__':
+
+    args = get_args()
+    lgr  = Logger(loglevel=args.verbose, classname=__name__)
+
+    run_metrics = RunMetrics(loglevel=args.verbose)
+    for metrics_file in args.metrics_out:
+        atexit.register(run_metrics.write, metrics_file)
+
+    run_profiler = RunProfiler(
+                        profile_file=args.profile,
+                        trace_alloc=args.trace_alloc,
+                        top=args.profile_top,
+                        loglevel=args.verbose
+                    )
+    if args.profile is not None or args.trace_alloc:
+        atexit.register(run_profiler.finish)
+
+    if args.batch is not None:
+        for account_args in args.accounts:
+            check_outputs(account_args, lgr)
+
+        with run_profiler.stage('batch'):
+            changed = run_batch(args, lgr, run_metrics)
+
+        run_metrics.set_success()
+        sys.exit(0 if changed or not args.skip_unchanged else EXIT_UNCHANGED)
+
+    response_cache = None
+    if args.cache_dir is not None:
+        response_cache = ResponseCache(
+                            directory=args.cache_dir,
+                            max_size=args.cache_size << 20,
+                            ttls=args.cache_ttl,
+                            namespace=args.username,
+                            loglevel=args.verbose
+                        )
+
+    epg_state = None
+    if args.epg_state is not None and args.mode in ('all', 'epg'):
+        epg_state = EPGState(
+                        file=args.epg_state,
+                        horizon=args.epg_horizon * 3600,
+                        loglevel=args.verbose
+                    )
+
+    if args.serve:
+        paths = tuple(path for path, mode in (
+                        ('/playlist.m3u', 'm3u'), ('/epg.xml', 'epg'))
+                        if args.mode in ('all', mode))
+
+        smotreshka_obj = Smotreshka(
+                            username=args.username,
+                            password=args.password,
+                            limit=args.limit,
+                            mode=args.mode,
+                            concurrency=args.concurrency,
+                            prefetch=False,
+                            cache=response_cache,
+                            epg_state=epg_state,
+                            stream_base_url=args.public_url
+                                if args.lazy_streams else None,
+                            stream_ttl=args.stream_ttl,
+                            session_file=args.session_file,
+                            rate_limit=args.rate_limit,
+                            retries=args.retries,
+                            timeout=args.timeout,
+                            hedge_percentile=args.hedge_percentile,
+                            hedge_budget=args.hedge_budget,
+                            metrics=run_metrics,
+                            epg_from=args.epg_from,
+                            epg_days=args.epg_days,
+                            channel_filter=args.channel_filter,
+                            loglevel=args.verbose
+                        )
+
+        LiveTVServer(
+            host=args.listen[0],
+            port=args.listen[1],
+            refresher=lambda: render_documents(smotreshka_obj, args,
+                                                run_metrics),
+            resolver=smotreshka_obj.resolve_stream
+                if args.lazy_streams else None,
+            paths=paths,
+            volatile={'/epg.xml': XMLTV_VOLATILE},
+            interval=args.refresh_interval * 60,
+            loglevel=args.verbose
+        ).serve_forever()
+
+        sys.exit(0)
+
+    check_outputs(args, lgr)
+
+    with run_profiler.stage('Smotreshka'):
+        smotreshka_obj = Smotreshka(
+                            username=args.username,
+                            password=args.password,
+                            limit=args.limit,
+                            mode=args.mode,
+                            concurrency=args.concurrency,
+                            prefetch=not args.pipeline,
+                            cache=response_cache,
+                            epg_state=epg_state,
+                            session_file=args.session_file,
+                            rate_limit=args.rate_limit,
+                            retries=args.retries,
+                            timeout=args.timeout,
+                            hedge_percentile=args.hedge_percentile,
+                            hedge_budget=args.hedge_budget,
+                            metrics=run_metrics,
+                            epg_from=args.epg_from,
+                            epg_days=args.epg_days,
+                            channel_filter=args.channel_filter,
+                            loglevel=args.verbose
+                        )
+
+    changed = write_outputs(smotreshka_obj, args, lgr, run_metrics,
+                            run_profiler)
+
+    run_metrics.set_success()
+
+    if not changed and args.skip_unchanged:
+        lgr.logger.info('No output file changed')
 
-        with open(
-            file=args.m3u_output,
-            mode='w',
-            encoding='utf8'
-        ) as m3u_playlist:
-            m3u_playlist.write(m3u_playlist_obj.make_m3u_playlist())
-            lgr.logger.info(
-                'Please find generated M3U playlist\n\t- %s',
-                Path(args.m3u_output).resolve())
+        sys.exit(EXIT_UNCHANGED)
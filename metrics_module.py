@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Metrics Module """
+
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Iterator
+from itertools import accumulate
+from contextlib import contextmanager
+from pathlib import Path
+from logger_module import Logger
+from output_module import atomic_open
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class RunMetrics:
+    """
+    Structured metrics of a single run
+
+    Stage durations are wall time of sequential stages, and the sum of
+    per-item time over parallel workers for fetch stages and sharded XMLTV
+    writes. Output rendering is timed apart from the file writes it is
+    streamed to. Requests are recorded per attempt, retries and hedges
+    included, with the latency of the attempt alone. Metrics are written as
+    JSON, or in Prometheus text format for files with .prom suffix to be
+    picked up by the node exporter textfile collector
+    """
+
+    def __init__(self, loglevel: int=20) -> None:
+        self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._success = False
+        self._stages: dict[str, float] = defaultdict(float)
+        self._stage_errors: Counter = Counter()
+        self._requests: Counter = Counter()
+        self._response_bytes: Counter = Counter()
+        self._cache_hits: Counter = Counter()
+        self._latency_buckets: dict[str, list[int]] = defaultdict(
+                                    lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self._latency_sums: dict[str, float] = defaultdict(float)
+        self._emitted: Counter = Counter()
+
+    @contextmanager
+    def stage(self, name: str=None) -> Iterator[None]:
+        """ Add time spent within the context to the stage """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._stages[name] += elapsed
+
+    def time_chunks(self, name: str=None, chunks: Iterable[str]=None,
+                    within: str=None) -> Iterator[str]:
+        """
+        Generate the chunks adding time spent producing them to the stage,
+        the time is taken from the enclosing stage consuming them if set
+        """
+
+        elapsed = 0.0
+        iterator = iter(chunks)
+
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield chunk
+        finally:
+            with self._lock:
+                self._stages[name] += elapsed
+                if within is not None:
+                    self._stages[within] -= elapsed
+
+    def count_error(self, stage: str=None) -> None:
+        """ Count failed stage item """
+
+        with self._lock:
+            self._stage_errors[stage] += 1
+
+    def observe_request(self, endpoint: str=None, status: int | str=None,
+                        size: int=0, latency: float=0) -> None:
+        """ Record request to the endpoint """
+
+        with self._lock:
+            self._requests[endpoint, str(status)] += 1
+            self._response_bytes[endpoint] += size
+            self._latency_buckets[endpoint][
+                            bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self._latency_sums[endpoint] += latency
+
+    def observe_cache_hit(self, endpoint: str=None) -> None:
+        """ Record request to the endpoint served from the cache """
+
+        with self._lock:
+            self._cache_hits[endpoint] += 1
+
+    def count_emitted(self, name: str=None, count: int=1) -> None:
+        """ Count emitted output entries """
+
+        with self._lock:
+            self._emitted[name] += count
+
+    def set_success(self) -> None:
+        """ Mark the run as succeeded """
+
+        self._success = True
+
+    def make_dict(self) -> dict:
+        """ Return metrics as a dict """
+
+        with self._lock:
+            return {
+                'started': self._started,
+                'duration': time.time() - self._started,
+                'success': self._success,
+                'stages': {
+                    name: {
+                        'seconds': round(seconds, 6),
+                        'errors': self._stage_errors[name]
+                    } for name, seconds in self._stages.items()
+                } | {
+                    name: {'seconds': 0, 'errors': errors}
+                    for name, errors in self._stage_errors.items()
+                    if name not in self._stages
+                },
+                'requests': {
+                    endpoint: {
+                        'statuses': {
+                            status: count for (name, status), count
+                            in sorted(self._requests.items())
+                            if name == endpoint
+                        },
+                        'bytes': self._response_bytes[endpoint],
+                        'cache_hits': self._cache_hits[endpoint],
+                        'latency': {
+                            'sum': round(self._latency_sums[endpoint], 6),
+                            # Cumulative counts of requests not slower
+                            # than the bound, as in Prometheus
+                            'buckets': dict(zip(
+                                [str(bound) for bound in LATENCY_BUCKETS]
+                                    + ['+Inf'],
+                                accumulate(self._latency_buckets[endpoint])))
+                        }
+                    } for endpoint in sorted(
+                        set(self._response_bytes) | set(self._cache_hits))
+                },
+                'emitted': dict(self._emitted)
+            }
+
+    @staticmethod
+    def _escape_label(value: str=None) -> str:
+        """ Escape Prometheus label value """
+
+        return (value.replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    def make_prometheus(self) -> str:
+        """ Return metrics in Prometheus text exposition format """
+
+        metrics = self.make_dict()
+        lines = []
+
+        def add(name: str, kind: str, description: str,
+                samples: list[tuple[str, dict, float]]) -> None:
+            """ Add metric family, samples are (suffix, labels, value) """
+
+            lines.append(f'# HELP smotreshka_{name} {description}')
+            lines.append(f'# TYPE smotreshka_{name} {kind}')
+
+            for suffix, labels, value in samples:
+                label_text = ','.join(
+                    f'{key}="{self._escape_label(str(label))}"'
+                    for key, label in labels.items())
+                lines.append(f'smotreshka_{name}{suffix}'
+                    + (f'{{{label_text}}}' if label_text else '')
+                    + f' {value}')
+
+        add('run_start_timestamp_seconds', 'gauge',
+            'Unix time the run started at',
+            [('', {}, metrics['started'])])
+        add('run_duration_seconds', 'gauge', 'Wall time of the run',
+            [('', {}, metrics['duration'])])
+        add('run_success', 'gauge', 'Whether the run succeeded',
+            [('', {}, int(metrics['success']))])
+        add('stage_duration_seconds', 'gauge',
+            'Time spent in the stage, summed over parallel workers',
+            [('', {'stage': stage}, values['seconds'])
+                for stage, values in metrics['stages'].items()])
+        add('stage_errors', 'gauge', 'Number of failed items of the stage',
+            [('', {'stage': stage}, values['errors'])
+                for stage, values in metrics['stages'].items()])
+        add('requests', 'gauge', 'Number of requests by endpoint and status',
+            [('', {'endpoint': endpoint, 'status': status}, count)
+                for endpoint, values in metrics['requests'].items()
+                for status, count in values['statuses'].items()])
+        add('response_bytes', 'gauge', 'Size of responses by endpoint',
+            [('', {'endpoint': endpoint}, values['bytes'])
+                for endpoint, values in metrics['requests'].items()])
+        add('cache_hits', 'gauge',
+            'Number of requests served from the cache by endpoint',
+            [('', {'endpoint': endpoint}, values['cache_hits'])
+                for endpoint, values in metrics['requests'].items()])
+
+        histogram = []
+        for endpoint, values in metrics['requests'].items():
+            for bound, count in values['latency']['buckets'].items():
+                histogram.append(('_bucket',
+                                    {'endpoint': endpoint, 'le': bound}, count))
+            histogram.append(('_sum', {'endpoint': endpoint},
+                                values['latency']['sum']))
+            histogram.append(('_count', {'endpoint': endpoint},
+                                values['latency']['buckets']['+Inf']))
+
+        add('request_duration_seconds', 'histogram',
+            'Latency of requests by endpoint', histogram)
+        add('emitted', 'gauge', 'Number of emitted output entries',
+            [('', {'entry': name}, count)
+                for name, count in metrics['emitted'].items()])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file: str=None) -> None:
+        """ Write metrics to the file, Prometheus format for .prom files """
+
+        with atomic_open(file=file) as output:
+            if Path(file).suffix == '.prom':
+                output.write(self.make_prometheus())
+            else:
+                json.dump(self.make_dict(), output, indent=4)
+
+        self._lgr.logger.info('Write run metrics to %s', file)
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
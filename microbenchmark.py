@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+""" Smotreshka Live TV Ripper: Render Microbenchmarks """
+
+import argparse
+import gc
+import html
+import json
+import platform
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+from epg_module import EPGChannelEntry, EPGListing, EPGProgramEntry
+from logger_module import Logger
+from m3u_module import M3UChannelEntry, M3UPlaylist
+from output_module import atomic_open
+
+BASELINE_FILE = Path(__file__).with_name('microbenchmark_baseline.json')
+
+# Minimum wall time of a single benchmark run in seconds
+MIN_RUN_TIME = 0.5
+
+# Default number of runs per benchmark, the best one is taken
+REPEAT = 7
+
+# Synthetic fixture epoch, aligned to an hour to look like a real schedule
+EPOCH = 1767225600
+
+def get_args() -> argparse.Namespace:
+    """ Parse CLI arguments """
+
+    args_parser = argparse.ArgumentParser(
+            description='Smotreshka Live TV Ripper microbenchmarks of the '
+                        'render hot paths')
+    args_parser.add_argument(
+                '--channels',
+                type=int,
+                default=200,
+                help='Number of synthetic channels. Default: 200'
+            )
+    args_parser.add_argument(
+                '--programs',
+                type=int,
+                default=1500,
+                help='Number of synthetic EPG programs per channel. '
+                     'Default: 1500'
+            )
+    args_parser.add_argument(
+                '-r', '--repeat',
+                type=int,
+                default=REPEAT,
+                help='Number of runs per benchmark, the best one is taken. '
+                     f'Default: {REPEAT}'
+            )
+    args_parser.add_argument(
+                '-b', '--benchmark',
+                type=str,
+                action='append',
+                default=[],
+                help='Benchmark to run, can be set multiple times. '
+                     'Default: all of ' + ', '.join(BENCHMARKS)
+            )
+    args_parser.add_argument(
+                '-t', '--threshold',
+                type=float,
+                default=20,
+                help='Allowed throughput regression against the baseline in '
+                     'percent. Default: 20'
+            )
+    args_parser.add_argument(
+                '--baseline',
+                type=str,
+                default=str(BASELINE_FILE),
+                help=f'Baseline results file. Default: {BASELINE_FILE.name}'
+            )
+    args_parser.add_argument(
+                '-u', '--update-baseline',
+                help='Store the results as the new baseline instead of '
+                     'comparing with it. Default: false',
+                action='store_true',
+                default=False
+            )
+
+    args_parsed = args_parser.parse_args()
+
+    for benchmark in args_parsed.benchmark:
+        if benchmark not in BENCHMARKS:
+            args_parser.error(f'unknown benchmark: {benchmark}')
+
+    return args_parsed
+
+def make_programs(channel_id: str=None, programs: int=None) -> list:
+    """ Create synthetic EPG programs of the channel """
+
+    category = ['Кино']
+
+    return [EPGProgramEntry(
+                channel_id=channel_id,
+                start=EPOCH + index * 1800,
+                stop=EPOCH + (index + 1) * 1800,
+                title=f'Программа {index % 40} "Серия {index}"',
+                desc=f'Описание программы {index} & <подробности> ' * 4,
+                category=category,
+                icon=f'https://static.example/{channel_id}/{index}.jpg?w=1&h=2'
+            ) for index in range(programs)]
+
+def make_epg_channel(index: int=None) -> EPGChannelEntry:
+    """ Create synthetic EPG channel """
+
+    return EPGChannelEntry(
+                channel_id=f'{0x52d555c99109550984000000 + index:024x}',
+                display_name=f'Канал {index + 1}',
+                icon=f'https://static.example/{index}.png',
+                language='ru_RU'
+            )
+
+def make_m3u_channel(index: int=None) -> M3UChannelEntry:
+    """ Create synthetic M3U channel """
+
+    channel_id = f'{0x52d555c99109550984000000 + index:024x}'
+
+    return M3UChannelEntry(
+                title=f'Канал {index + 1}',
+                url=f'https://stream.example/{channel_id}/index.m3u8?t=1',
+                group_title=['Общие', 'Кино'],
+                tvg_chno=index + 1,
+                tvg_id=channel_id,
+                tvg_logo=f'https://static.example/{index}.png',
+                tvg_language='ru_RU'
+            )
+
+def bench_program_construction(channels: int, programs: int
+                                ) -> tuple[Callable[[], object], int]:
+    """ EPGProgramEntry construction with __post_init__ validation """
+
+    return lambda: make_programs('channel', programs), programs
+
+def bench_channel_construction(channels: int, programs: int
+                                ) -> tuple[Callable[[], object], int]:
+    """ EPGChannelEntry and M3UChannelEntry construction with __post_init__ """
+
+    def run() -> None:
+        for index in range(channels):
+            make_epg_channel(index)
+            make_m3u_channel(index)
+
+    return run, 2 * channels
+
+def bench_make_epg_entry(channels: int, programs: int
+                            ) -> tuple[Callable[[], object], int]:
+    """ EPGChannelEntry.make_epg_entry of one channel, per program """
+
+    channel = make_epg_channel(0)
+    channel.extend_programs(make_programs(channel.channel_id, programs))
+
+    return channel.make_epg_entry, programs
+
+def bench_append_epg_program(channels: int, programs: int
+                                ) -> tuple[Callable[[], object], int]:
+    """ EPGListing.append_epg_program of all programs of one channel """
+
+    channel = make_epg_channel(0)
+    channel_programs = make_programs(channel.channel_id, programs)
+
+    def run() -> None:
+        epg_listing = EPGListing(loglevel=30)
+        epg_listing.append_epg_channel(channel)
+        channel.program = []
+
+        for program in channel_programs:
+            epg_listing.append_epg_program(channel, program)
+
+    return run, programs
+
+def bench_make_epg_listing(channels: int, programs: int
+                            ) -> tuple[Callable[[], object], int]:
+    """ EPGListing.make_epg_listing of all channels, per program """
+
+    epg_listing = EPGListing(loglevel=30)
+
+    for index in range(channels):
+        channel = make_epg_channel(index)
+        epg_listing.append_epg_channel(channel)
+        epg_listing.extend_programs(channel.channel_id,
+                                    make_programs(channel.channel_id, programs))
+
+    return epg_listing.make_epg_listing, channels * programs
+
+def bench_make_m3u_entry(channels: int, programs: int
+                            ) -> tuple[Callable[[], object], int]:
+    """ M3UChannelEntry.make_m3u_entry of all channels """
+
+    m3u_channels = [make_m3u_channel(index) for index in range(channels)]
+
+    def run() -> None:
+        for channel in m3u_channels:
+            channel.make_m3u_entry()
+
+    return run, channels
+
+def bench_make_m3u_playlist(channels: int, programs: int
+                            ) -> tuple[Callable[[], object], int]:
+    """ M3UPlaylist.make_m3u_playlist of all channels """
+
+    m3u_playlist = M3UPlaylist(loglevel=30)
+
+    for index in range(channels):
+        m3u_playlist.append_m3u_channel(make_m3u_channel(index))
+
+    return m3u_playlist.make_m3u_playlist, channels
+
+BENCHMARKS = {
+    'program_construction': bench_program_construction,
+    'channel_construction': bench_channel_construction,
+    'make_epg_entry': bench_make_epg_entry,
+    'append_epg_program': bench_append_epg_program,
+    'make_m3u_entry': bench_make_m3u_entry,
+    'make_m3u_playlist': bench_make_m3u_playlist,
+    # The largest fixture goes last not to disturb the others
+    'make_epg_listing': bench_make_epg_listing
+}
+
+def calibrate() -> tuple[Callable[[], object], int]:
+    """
+    Formatting and escaping loop independent of the code under test, the
+    throughput of the benchmarks is compared relative to it so baselines
+    hold across hosts and load
+    """
+
+    def run() -> None:
+        for index in range(1000):
+            html.escape(f'Программа {index % 40} & <Серия {index}>')
+
+    return run, 1000
+
+def time_loops(run: Callable[[], object]=None, loops: int=None) -> float:
+    """ Return wall time of the loops of the benchmark without GC pauses """
+
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        for _ in range(loops):
+            run()
+        return time.perf_counter() - started
+    finally:
+        gc.enable()
+
+def count_loops(run: Callable[[], object]=None) -> int:
+    """ Return number of loops for the benchmark to run long enough """
+
+    loops = 1
+    while time_loops(run, loops) < MIN_RUN_TIME:
+        loops *= 2
+
+    return loops
+
+def run_benchmark(name: str=None, channels: int=None, programs: int=None,
+                    repeat: int=None) -> tuple[float, float]:
+    """
+    Return best throughput of the benchmark and of the calibration loop in
+    operations per second. Fast benchmarks are looped to run long enough
+    for a stable timing, and their runs alternate with the calibration runs
+    so both see the same host load
+    """
+
+    run, operations = BENCHMARKS[name](channels, programs)
+    calibration_run, calibration_operations = calibrate()
+
+    loops = count_loops(run)
+    calibration_loops = count_loops(calibration_run)
+
+    best = calibration_best = float('inf')
+    for _ in range(max(1, repeat)):
+        best = min(best, time_loops(run, loops))
+        calibration_best = min(calibration_best,
+                                time_loops(calibration_run, calibration_loops))
+
+    return (operations * loops / best,
+            calibration_operations * calibration_loops / calibration_best)
+
+if __name__ == '__main__':
+
+    args = get_args()
+    lgr = Logger(classname=__name__)
+
+    baseline = {}
+    if not args.update_baseline:
+        try:
+            baseline = json.loads(Path(args.baseline).read_text(
+                                                'utf8')).get('benchmarks', {})
+        except (OSError, ValueError) as err:
+            lgr.logger.warning('Cannot load baseline %s, only measure: %s',
+                args.baseline, err)
+
+    results = {}
+    regressions = []
+
+    for name in args.benchmark or BENCHMARKS:
+        throughput, calibration = run_benchmark(name, args.channels,
+                                                args.programs, args.repeat)
+        relative = throughput / calibration
+        results[name] = {
+            'ops_per_second': round(throughput, 1),
+            'calibration_ops_per_second': round(calibration, 1),
+            'relative': round(relative, 6)
+        }
+
+        baseline_relative = baseline.get(name, {}).get('relative')
+        if baseline_relative is None:
+            lgr.logger.info('%s: %.0f ops/s, %.4f of calibration',
+                name, throughput, relative)
+            continue
+
+        change = (relative / baseline_relative - 1) * 100
+        lgr.logger.info('%s: %.0f ops/s, %.4f of calibration, %+.1f%% '
+            'against baseline %.4f', name, throughput, relative, change,
+            baseline_relative)
+
+        if change < -args.threshold:
+            regressions.append(name)
+
+    if args.update_baseline:
+        with atomic_open(file=args.baseline) as baseline_file:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'channels': args.channels,
+                'programs': args.programs,
+                'benchmarks': results
+            }, baseline_file, indent=4)
+            baseline_file.write('\n')
+
+        lgr.logger.info('Please find the updated baseline\n\t- %s',
+            Path(args.baseline).resolve())
+
+    if regressions:
+        lgr.logger.critical('Throughput regressed by more than %.0f%%: %s',
+            args.threshold, ', '.join(regressions))
+
+        # sysexits.h: EX_SOFTWARE
+        sys.exit(70)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Mock Module """
+
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from logger_module import Logger
+
+@dataclass(frozen=True)
+class MockConfig:
+    """
+    Shape of the data and behaviour of the mock Smotreshka API
+
+    Attributes
+    ----------
+    channels: int
+        Number of purchased channels
+    programs: int
+        Number of EPG programs per channel
+    latency: float
+        Base response latency in seconds
+    tail_ratio: float
+        Share of responses delayed by the tail latency
+    tail_latency: float
+        Extra latency in seconds of the delayed responses
+    error_rate: float
+        Share of programs and playback-info responses failed with 503
+    seed: int
+        Seed of the latency and error distributions
+    """
+
+    channels: int = 100
+    programs: int = 150
+    latency: float = 0.03
+    tail_ratio: float = 0.05
+    tail_latency: float = 0.5
+    error_rate: float = 0
+    seed: int = 0
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """ Serve Smotreshka API endpoints with generated data """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format: str, *args) -> None: # pylint: disable=redefined-builtin
+        pass
+
+    def _send_json(self, status: int=200, body: dict=None,
+                    headers: dict=None) -> None:
+        """ Send JSON response """
+
+        content = json.dumps(body or {}, ensure_ascii=False).encode('utf8')
+
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _delay(self) -> bool:
+        """ Sleep for the sampled latency, return if the request fails """
+
+        api = self.server.api
+
+        with api.lock:
+            latency = api.config.latency
+            if api.random.random() < api.config.tail_ratio:
+                latency += api.config.tail_latency
+            failed = api.random.random() < api.config.error_rate
+
+        time.sleep(latency)
+
+        return failed
+
+    def do_POST(self) -> None: # pylint: disable=invalid-name
+        """ Serve login """
+
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.api.count('login', 200)
+        self._delay()
+
+        if self.path != '/login':
+            self._send_json(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'session=mock; Path=/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self) -> None: # pylint: disable=invalid-name
+        """ Serve channels, programs and playback info """
+
+        api = self.server.api
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+
+        if parts == ['_stats']:
+            self._send_json(200, api.get_stats())
+            return
+
+        if parts == ['channels']:
+            endpoint, body = 'channels', api.make_channels()
+        elif len(parts) == 3 and parts[0] == 'channels' \
+            and parts[2] == 'programs':
+            endpoint, body = 'programs', api.make_programs(parts[1])
+        elif len(parts) == 2 and parts[0] == 'playback-info':
+            endpoint, body = 'playback-info', api.make_playback_info(parts[1])
+        else:
+            api.count('unknown', 404)
+            self._send_json(404)
+            return
+
+        if self._delay() and endpoint != 'channels':
+            api.count(endpoint, 503)
+            self._send_json(503, headers={'Retry-After': '0'})
+            return
+
+        api.count(endpoint, 200)
+        self._send_json(200, body)
+
+class MockSmotreshkaAPI:
+    """
+    Local stand-in for the Smotreshka API serving generated channels, EPG
+    programs and media streams with injected latency and errors
+    """
+
+    def __init__(self, config: MockConfig=None) -> None:
+        self.config = config or MockConfig()
+        self.lock = threading.Lock()
+        self.random = random.Random(self.config.seed)
+        self._stats = Counter()
+        self._epoch = int(time.time()) // 3600 * 3600
+        self._channel_ids = [f'{0x52d555c99109550984000000 + index:024x}'
+                                for index in range(self.config.channels)]
+
+    def count(self, endpoint: str=None, status: int=None) -> None:
+        """ Count served request """
+
+        with self.lock:
+            self._stats[f'{endpoint} {status}'] += 1
+
+    def get_stats(self) -> dict:
+        """ Return numbers of served requests by endpoint and status """
+
+        with self.lock:
+            return dict(self._stats)
+
+    def make_channels(self) -> dict:
+        """ Return channels response """
+
+        genres = ['Общие', 'Кино', 'Спорт', 'Детские', 'Новости']
+
+        return {'channels': [{
+            'id': channel_id,
+            'info': {
+                'purchaseInfo': {'bought': True},
+                'metaInfo': {
+                    'title': f'{index + 1}_Канал {index + 1}',
+                    'genres': [genres[index % len(genres)]]
+                },
+                'mediaInfo': {'thumbnails': [{
+                    'url': f'https://static.example/{channel_id}.png'
+                }]}
+            }
+        } for index, channel_id in enumerate(self._channel_ids)]}
+
+    def make_programs(self, channel_id: str=None) -> dict:
+        """ Return EPG programs response starting a day ago """
+
+        start = self._epoch - 86400
+        duration = 3600
+
+        return {'programs': [{
+            'scheduleInfo': {
+                'start': start + index * duration,
+                'end': start + (index + 1) * duration
+            },
+            'metaInfo': {
+                'title': f'Программа {index % 40} "Серия {index}"',
+                'description': f'Описание программы {index} & <подробности>'
+            },
+            'mediaInfo': {'thumbnails': [{
+                'url': f'https://static.example/{channel_id}/{index}.jpg?w=1&h=2'
+            }]}
+        } for index in range(self.config.programs)]}
+
+    @staticmethod
+    def make_playback_info(channel_id: str=None) -> dict:
+        """ Return playback info response """
+
+        return {'languages': [{
+            'id': 'ru-RU',
+            'default': True,
+            'renditions': [{
+                'id': 'Auto',
+                'default': True,
+                'url': f'https://stream.example/{channel_id}/index.m3u8?t=1'
+            }]
+        }]}
+
+def _serve(config: MockConfig=None, connection=None) -> None:
+    """ Serve mock API until terminated, send the bound port back """
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), MockRequestHandler)
+    httpd.daemon_threads = True
+    httpd.api = MockSmotreshkaAPI(config)
+
+    connection.send(httpd.server_address[1])
+    connection.close()
+
+    httpd.serve_forever()
+
+class MockSmotreshkaServer:
+    """
+    Mock Smotreshka API served from a separate process, so it does not
+    compete with the measured client for the interpreter lock
+    """
+
+    def __init__(self, config: MockConfig=None, loglevel: int=20) -> None:
+        self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
+        self.config = config or MockConfig()
+        self.base_url = None
+        self._process = None
+
+    def __enter__(self) -> 'MockSmotreshkaServer':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """ Start mock API process """
+
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+
+        self._process = context.Process(target=_serve,
+                                        args=(self.config, sender),
+                                        name='mock-smotreshka', daemon=True)
+        self._process.start()
+        sender.close()
+
+        self.base_url = f'http://127.0.0.1:{receiver.recv()}'
+        receiver.close()
+
+        self._lgr.logger.info('Serve mock Smotreshka API on %s with %s',
+            self.base_url, asdict(self.config))
+
+    def get_stats(self) -> dict:
+        """ Return numbers of served requests by endpoint and status """
+
+        return requests.get(f'{self.base_url}/_stats', timeout=10).json()
+
+    def stop(self) -> None:
+        """ Stop mock API process """
+
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
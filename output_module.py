@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Output Module """
+
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import re
+import sys
+import tempfile
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import BinaryIO, TextIO
+from logger_module import Logger
+
+# Size of the buffer used for output files to avoid a syscall per entry
+WRITE_BUFFER_SIZE = 1 << 16
+
+# Output file suffixes compressed on the fly
+COMPRESSED_SUFFIXES = ('.gz', '.xz')
+
+def _read_umask() -> int:
+    """ Return the process umask, it can only be read by setting it """
+
+    umask = os.umask(0o077)
+    os.umask(umask)
+
+    return umask
+
+# Read once at import, before any writer threads run, as setting the umask
+# even for a moment affects files created by all threads
+UMASK = _read_umask()
+
+class TeeWriter:
+    """ Text output writing the same content to several outputs """
+
+    def __init__(self, outputs: list[TextIO]=None) -> None:
+        self._outputs = outputs
+
+    def write(self, text: str=None) -> int:
+        """ Write text to all outputs """
+
+        for output in self._outputs:
+            output.write(text)
+
+        return len(text)
+
+    def writelines(self, lines: Iterable[str]=None) -> None:
+        """ Write lines to all outputs, consuming them only once """
+
+        for line in lines:
+            self.write(line)
+
+def get_plain_file(file: str=None) -> Path | None:
+    """ Return path of the file without compression suffix, None if plain """
+
+    target = Path(file)
+    if target.suffix not in COMPRESSED_SUFFIXES:
+        return None
+
+    return target.with_suffix('')
+
+def _get_base_name(target: Path=None) -> tuple[str, str]:
+    """ Return file name without .xml and compression suffixes, and them """
+
+    compressed_suffix = target.suffix if target.suffix in COMPRESSED_SUFFIXES \
+                            else ''
+    name = target.name.removesuffix(compressed_suffix)
+
+    return name.removesuffix('.xml'), compressed_suffix
+
+def _get_slug(key: str=None) -> str:
+    """ Return the shard key with characters unsafe in file names replaced """
+
+    return re.sub(r'[^\w.-]+', '_', key).strip('_.') or '_'
+
+def get_shard_file(file: str=None, key: str=None,
+                    unique: bool=False) -> Path:
+    """
+    Return path of the shard of the file, the shard key goes before .xml
+    and compression suffixes with characters unsafe in file names replaced.
+    Unique paths carry a short hash of the key
+    """
+
+    target = Path(file)
+    base_name, compressed_suffix = _get_base_name(target)
+    slug = _get_slug(key)
+    if unique:
+        slug += '-' + hashlib.sha256(key.encode('utf8')).hexdigest()[:8]
+
+    return target.with_name(f'{base_name}.{slug}.xml{compressed_suffix}')
+
+def get_shard_files(file: str=None, keys: Iterable[str]=None
+                    ) -> dict[str, Path]:
+    """
+    Return paths of the shards of the file by key. Keys which end up with
+    the same file name, also on case insensitive file systems, get unique
+    paths
+    """
+
+    keys = list(keys)
+    slugs = Counter(_get_slug(key).casefold() for key in keys)
+
+    return {key: get_shard_file(file, key,
+                                unique=slugs[_get_slug(key).casefold()] > 1)
+            for key in keys}
+
+def get_manifest_file(file: str=None) -> Path:
+    """ Return path of the manifest listing shards of the file """
+
+    target = Path(file)
+
+    return target.with_name(f'{_get_base_name(target)[0]}.manifest.json')
+
+def _open_compressor(target: Path=None, output: BinaryIO=None) -> BinaryIO:
+    """ Wrap binary output into compressor chosen by the target suffix """
+
+    if target.suffix == '.gz':
+        # Fixed mtime keeps output reproducible for unchanged content
+        return gzip.GzipFile(filename=target.name, mode='wb',
+                                compresslevel=6, fileobj=output, mtime=0)
+
+    return lzma.LZMAFile(output, mode='wb')
+
+@contextmanager
+def atomic_open(file: str=None, encoding: str='utf8',
+                permissions: int=None) -> Iterator[TextIO]:
+    """
+    Open a temporary file next to the target file for writing and atomically
+    rename it into place on success, so readers never see partial content.
+    Permissions of the existing file are kept unless set explicitly. Files
+    with .gz or .xz suffix are compressed on the fly
+    """
+
+    target = Path(file)
+    file_descriptor, temp_name = tempfile.mkstemp(
+                                        dir=target.resolve().parent,
+                                        prefix=f'.{target.name}.',
+                                        suffix='.tmp')
+
+    try:
+        if target.suffix in COMPRESSED_SUFFIXES:
+            with os.fdopen(file_descriptor, mode='wb',
+                            buffering=WRITE_BUFFER_SIZE) as raw_output:
+                # Closing the text output finishes the compressed stream,
+                # the raw output is left open
+                with io.TextIOWrapper(_open_compressor(target, raw_output),
+                                        encoding=encoding) as output:
+                    yield output
+                raw_output.flush()
+                os.fsync(raw_output.fileno())
+        else:
+            with os.fdopen(file_descriptor, mode='w', encoding=encoding,
+                            buffering=WRITE_BUFFER_SIZE) as output:
+                yield output
+                output.flush()
+                os.fsync(output.fileno())
+
+        # mkstemp creates 0600 files, keep the mode readers would expect
+        if permissions is not None:
+            os.chmod(temp_name, permissions)
+        elif target.exists():
+            os.chmod(temp_name, target.stat().st_mode & 0o7777)
+        else:
+            os.chmod(temp_name, 0o666 & ~UMASK)
+
+        os.replace(temp_name, target)
+
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+
+@contextmanager
+def open_output(file: str=None, plain_copy: bool=False,
+                encoding: str='utf8') -> Iterator[TextIO]:
+    """
+    Open output file atomically. With plain copy set, a compressed file is
+    written along with its uncompressed copy next to it in one pass
+    """
+
+    plain_file = get_plain_file(file) if plain_copy else None
+
+    with ExitStack() as stack:
+        output = stack.enter_context(atomic_open(file=file, encoding=encoding))
+
+        if plain_file is None:
+            yield output
+        else:
+            yield TeeWriter([output, stack.enter_context(
+                            atomic_open(file=plain_file, encoding=encoding))])
+
+def _open_reader(target: Path=None, encoding: str='utf8') -> TextIO:
+    """ Open the file for reading, decompressing it by the suffix """
+
+    if target.suffix == '.gz':
+        return gzip.open(target, mode='rt', encoding=encoding)
+    if target.suffix == '.xz':
+        return lzma.open(target, mode='rt', encoding=encoding)
+
+    return open(target, mode='r', encoding=encoding,
+                buffering=WRITE_BUFFER_SIZE)
+
+class UnchangedWriter:
+    """
+    Text output compared with the existing file as it is written
+
+    The file is only opened for writing at the first difference, and the
+    matched part is copied over from the existing file, so the content is
+    neither kept in memory nor rendered twice. The volatile pattern is
+    removed from the first chunk written and its counterpart before they
+    are compared, which suits headers carrying the generation time
+    """
+
+    def __init__(self, file: str=None, opener: Callable[[], TextIO]=None,
+                    volatile: re.Pattern=None, encoding: str='utf8') -> None:
+
+        self._target = Path(file)
+        self._opener = opener
+        self._volatile = volatile
+        self._encoding = encoding
+        self._existing: TextIO | None = None
+        self._output: TextIO | None = None
+        self._first_chunk: str | None = None
+        self._matched = 0
+        self.changed = True
+
+    def open_existing(self) -> None:
+        """ Open the existing file to compare with, if it is readable """
+
+        try:
+            self._existing = _open_reader(self._target, self._encoding)
+        except OSError:
+            self._existing = None
+
+    def close_existing(self) -> None:
+        """ Close the existing file """
+
+        if self._existing is not None:
+            self._existing.close()
+            self._existing = None
+
+    def _read_existing(self, size: int=None) -> str | None:
+        """ Read from the existing file, None if it cannot be read """
+
+        try:
+            return self._existing.read(size)
+        except (OSError, ValueError, EOFError, lzma.LZMAError):
+            return None
+
+    def _switch(self) -> None:
+        """ Open the file for writing and copy the matched content to it """
+
+        self._output = self._opener()
+
+        if self._matched > 0:
+            # The first chunk may differ in the volatile part
+            self._output.write(self._first_chunk)
+            remaining = self._matched - len(self._first_chunk)
+
+            with _open_reader(self._target, self._encoding) as existing:
+                existing.read(len(self._first_chunk))
+                while remaining > 0:
+                    text = existing.read(min(remaining, WRITE_BUFFER_SIZE))
+                    if not text:
+                        break
+                    self._output.write(text)
+                    remaining -= len(text)
+
+        self.close_existing()
+
+    def write(self, text: str=None) -> int:
+        """ Compare text with the existing file, write it once it differs """
+
+        if self._output is None and self._existing is not None:
+            compared_text = text
+            existing_text = self._read_existing(len(text))
+
+            if self._first_chunk is None:
+                self._first_chunk = text
+                if self._volatile is not None and existing_text is not None:
+                    compared_text = self._volatile.sub('', text, 1)
+                    existing_text = self._volatile.sub('', existing_text, 1)
+
+            if compared_text == existing_text:
+                self._matched += len(text)
+                return len(text)
+
+        if self._output is None:
+            self._switch()
+
+        return self._output.write(text)
+
+    def writelines(self, lines: Iterable[str]=None) -> None:
+        """ Write lines one by one """
+
+        for line in lines:
+            self.write(line)
+
+    def finish(self) -> None:
+        """ Write the file unless its whole content matched """
+
+        if (self._output is None and self._existing is not None
+            and self._read_existing(1) == ''):
+            self.changed = False
+        elif self._output is None:
+            self._switch()
+
+        self.close_existing()
+
+@contextmanager
+def open_unchanged(file: str=None, plain_copy: bool=False,
+                    volatile: re.Pattern=None,
+                    encoding: str='utf8') -> Iterator[UnchangedWriter]:
+    """
+    Open output file to be written atomically only if the content differs
+    from the existing file. The writer tells if the file changed once
+    closed. A missing plain copy is written along with the file
+    """
+
+    plain_file = get_plain_file(file) if plain_copy else None
+
+    with ExitStack() as stack:
+        writer = UnchangedWriter(file=file,
+                                    opener=lambda: stack.enter_context(
+                                        open_output(file=file,
+                                                    plain_copy=plain_copy,
+                                                    encoding=encoding)),
+                                    volatile=volatile,
+                                    encoding=encoding)
+
+        if plain_file is None or plain_file.exists():
+            writer.open_existing()
+
+        try:
+            yield writer
+            writer.finish()
+        finally:
+            writer.close_existing()
+
+def write_output(file: str=None, chunks: Iterable[str]=None,
+                    plain_copy: bool=False, skip_unchanged: bool=False,
+                    volatile: re.Pattern=None) -> bool:
+    """
+    Write chunks to the output file atomically, return whether the file
+    changed. With skip unchanged set, the file is not written when the
+    content is the same
+    """
+
+    if not skip_unchanged:
+        with open_output(file=file, plain_copy=plain_copy) as output:
+            output.writelines(chunks)
+        return True
+
+    with open_unchanged(file=file, plain_copy=plain_copy,
+                        volatile=volatile) as output:
+        output.writelines(chunks)
+
+    return output.changed
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Parser Module """
+
+import json
+import sys
+from logger_module import Logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Parser of EPG programs responses, the fastest one installed
+if orjson is not None:
+    PROGRAMS_PARSER = 'orjson'
+elif ijson is not None:
+    PROGRAMS_PARSER = 'ijson'
+else:
+    PROGRAMS_PARSER = 'json'
+
+# Errors raised on malformed responses, by the parsers or on unexpected
+# structure of the parsed data
+PARSE_ERRORS = (ValueError, LookupError, AttributeError, TypeError) + \
+    ((ijson.JSONError,) if ijson is not None else ())
+
+# ijson event prefixes of the program fields to keep
+_IJSON_FIELDS = {
+    'programs.item.scheduleInfo.start': 0,
+    'programs.item.scheduleInfo.end': 1,
+    'programs.item.metaInfo.title': 2,
+    'programs.item.metaInfo.description': 3
+}
+_IJSON_ICON = 'programs.item.mediaInfo.thumbnails.item.url'
+_IJSON_THUMBNAIL = 'programs.item.mediaInfo.thumbnails.item'
+
+def in_window(start: int=None, stop: int=None,
+                window: tuple[float | None, float | None]=None) -> bool:
+    """ Check the program overlaps the time window, open ends are None """
+
+    if window is None:
+        return True
+
+    window_start, window_stop = window
+
+    return ((window_start is None or stop > window_start)
+            and (window_stop is None or start < window_stop))
+
+def _check_row(row: tuple=None) -> tuple:
+    """ Return the program row, raise ValueError if it misses fields """
+
+    if None in row[:4]:
+        raise ValueError(f'program misses start, stop, title or '
+                         f'description: {row}')
+
+    return row
+
+def _pick_program(program: dict=None) -> tuple:
+    """
+    Return start, stop, title, description and icon of the program, the
+    icon is the URL of the first thumbnail or None
+    """
+
+    schedule_info = program.get('scheduleInfo') or {}
+    meta_info = program.get('metaInfo') or {}
+    thumbnails = (program.get('mediaInfo') or {}).get('thumbnails')
+
+    return _check_row((
+        schedule_info.get('start'),
+        schedule_info.get('end'),
+        meta_info.get('title'),
+        meta_info.get('description'),
+        (thumbnails[0] or {}).get('url') if thumbnails else None
+    ))
+
+def _iter_ijson_programs(content: bytes=None,
+                            window: tuple[float | None, float | None]=None):
+    """
+    Pick program fields from parser events without building the programs,
+    only the first thumbnail is kept, as by the other parsers
+    """
+
+    row = [None] * 5
+    thumbnail_seen = False
+
+    for prefix, event, value in ijson.parse(content, use_float=True):
+        index = _IJSON_FIELDS.get(prefix)
+
+        if index is not None:
+            row[index] = value
+        elif prefix == _IJSON_ICON and not thumbnail_seen:
+            row[4] = value
+        elif prefix == _IJSON_THUMBNAIL and event in ('end_map', 'null'):
+            thumbnail_seen = True
+        elif prefix == 'programs.item' and event == 'end_map':
+            program = _check_row(tuple(row))
+            if in_window(program[0], program[1], window):
+                yield program
+            row = [None] * 5
+            thumbnail_seen = False
+
+def parse_programs(content: bytes=None,
+                    window: tuple[float | None, float | None]=None
+                    ) -> list[tuple]:
+    """
+    Parse EPG programs response body into rows of
+    (start, stop, title, description, icon), other fields and programs
+    outside the time window are dropped, raise one of PARSE_ERRORS if the
+    body is malformed
+    """
+
+    if PROGRAMS_PARSER == 'ijson':
+        return list(_iter_ijson_programs(content, window))
+
+    if PROGRAMS_PARSER == 'orjson':
+        response_json = orjson.loads(content) # pylint: disable=no-member
+    else:
+        response_json = json.loads(content)
+
+    rows = (_pick_program(program)
+            for program in response_json.get('programs') or ())
+
+    return [row for row in rows if in_window(row[0], row[1], window)]
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Profile Module """
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from logger_module import Logger
+
+# Self time categories by substrings of the function file name, the first
+# match wins. Built-in functions are categorized by their name instead
+CATEGORIES = (
+    ('logging', ('logger_module.py', '/logging/')),
+    ('rendering', ('epg_module.py', 'm3u_module.py', 'output_module.py',
+                   '/html/', '/gzip.py', '/lzma.py')),
+    ('parsing', ('/json/', 'jsonmodule')),
+    # Environment lookups come from proxy resolution of requests
+    ('network', ('/requests/', '/urllib3/', '/urllib/', '/http/',
+                 '/socket.py', '/ssl.py', '/selectors.py', '/email/',
+                 '/os.py')),
+    ('waiting', ('/threading.py', '/concurrent/', '/queue.py')),
+    ('application', (str(Path(__file__).resolve().parent),))
+)
+
+# Files of the profilers, their allocation sites are left out of the
+# statistics
+PROFILER_FILES = frozenset((cProfile.__file__, pstats.__file__,
+                            tracemalloc.__file__, __file__))
+
+BUILTIN_CATEGORIES = (
+    # The logging listener waits on a SimpleQueue
+    ('waiting', ('acquire', 'sleep', 'wait', '_queue.')),
+    # Requests stat CA bundles and netrc files on every request
+    ('network', ('recv', 'send', 'connect', 'select', 'poll', '_ssl.',
+                 '_socket.', 'getaddrinfo', 'posix.stat')),
+    ('rendering', ('escape', 'write', 'join', 'compress')),
+    ('parsing', ('scanner', 'decode'))
+)
+
+def categorize(function: tuple[str, int, str]=None) -> str:
+    """ Return category of the profiled function """
+
+    filename, _, name = function
+
+    if filename == '~':
+        for category, markers in BUILTIN_CATEGORIES:
+            if any(marker in name for marker in markers):
+                return category
+        return 'other'
+
+    for category, markers in CATEGORIES:
+        if any(marker in filename for marker in markers):
+            return category
+
+    return 'other'
+
+def subtract_stats(stats: dict=None, baseline: dict=None) -> dict:
+    """ Return pstats statistics gathered since the baseline was taken """
+
+    delta = {}
+    for function, (cc, nc, tt, ct, callers) in stats.items():
+        base_cc, base_nc, base_tt, base_ct, base_callers = baseline.get(
+                                            function, (0, 0, 0, 0, {}))
+        if nc == base_nc:
+            continue
+
+        delta_callers = {}
+        for caller, values in callers.items():
+            base_values = base_callers.get(caller, (0, 0, 0, 0))
+            if values != base_values:
+                delta_callers[caller] = tuple(
+                    value - base_value
+                    for value, base_value in zip(values, base_values))
+
+        delta[function] = (cc - base_cc, nc - base_nc, tt - base_tt,
+                            ct - base_ct, delta_callers)
+
+    return delta
+
+class StatsSnapshot:
+    """ Statistics taken from a running profile, loadable by pstats """
+
+    def __init__(self, stats: dict=None) -> None:
+        self._stats = stats
+        self.stats = {}
+
+    def create_stats(self) -> None:
+        """ Provide a copy of the statistics, pstats takes it over """
+
+        self.stats = dict(self._stats)
+
+class RunProfiler:
+    """
+    Profile the run stage by stage with cProfile and tracemalloc
+
+    cProfile only follows the thread it is enabled in, so threads get their
+    own profiles running as long as the thread. Each stage takes what the
+    thread profiles gathered while it ran, threads living across stages are
+    attributed to each stage they did work in. The merged profile is dumped
+    as a pstats file, and a per-stage summary with self time by category
+    and top functions is logged. Allocations of the profilers are left out
+    """
+
+    def __init__(self, profile_file: str=None, trace_alloc: bool=False,
+                    top: int=20, loglevel: int=20) -> None:
+
+        self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
+        self._profile_file = profile_file
+        self._trace_alloc = trace_alloc
+        self._top = top
+        self._lock = threading.Lock()
+        self._profiles: dict[str, list[cProfile.Profile | StatsSnapshot]] = \
+                                                        defaultdict(list)
+        self._thread_profiles: list[cProfile.Profile] = []
+        self._wall_times: dict[str, float] = {}
+        self._allocations: dict[str, tuple[int, list]] = {}
+
+        if self._trace_alloc:
+            tracemalloc.start(8)
+
+    def _thread_hook(self, *_) -> None:
+        """ Enable a profile in a new thread """
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles all threads from the stage profile
+            return
+
+        with self._lock:
+            self._thread_profiles.append(profile)
+
+    def _snapshot_threads(self) -> dict[cProfile.Profile, dict]:
+        """ Return statistics gathered so far by the thread profiles """
+
+        with self._lock:
+            thread_profiles = list(self._thread_profiles)
+
+        snapshots = {}
+        for profile in thread_profiles:
+            profile.snapshot_stats()
+            snapshots[profile] = profile.stats
+
+        return snapshots
+
+    @contextmanager
+    def stage(self, name: str=None) -> Iterator[None]:
+        """ Profile the stage """
+
+        profile = None
+        if self._profile_file is not None:
+            profile = cProfile.Profile()
+            self._profiles[name].append(profile)
+            threading.setprofile(self._thread_hook)
+            baselines = self._snapshot_threads()
+            profile.enable()
+
+        if self._trace_alloc:
+            tracemalloc.reset_peak()
+
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self._wall_times[name] = time.perf_counter() - started
+
+            if profile is not None:
+                profile.disable()
+                for thread_profile, stats in self._snapshot_threads().items():
+                    delta = subtract_stats(stats,
+                                            baselines.get(thread_profile, {}))
+                    if delta:
+                        self._profiles[name].append(StatsSnapshot(delta))
+
+            if self._trace_alloc:
+                _, peak = tracemalloc.get_traced_memory()
+                # Filtering grouped statistics is much cheaper than
+                # filtering traces of the snapshot with tracemalloc.Filter
+                self._allocations[name] = (peak, [
+                    statistic for statistic in tracemalloc.take_snapshot(
+                                                    ).statistics('lineno')
+                    if statistic.traceback[0].filename not in PROFILER_FILES
+                ][:self._top])
+
+    def _make_stats(self, profiles: list[cProfile.Profile]=None
+                    ) -> pstats.Stats:
+        """ Merge profiles into statistics """
+
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+
+        return stats
+
+    def _log_profile(self, stage: str=None, stats: pstats.Stats=None) -> None:
+        """ Log self time by category and top functions of the stage """
+
+        categories = defaultdict(float)
+        for function, (_, _, tottime, _, _) in (
+                stats.stats.items()): # pylint: disable=no-member
+            categories[categorize(function)] += tottime
+
+        total = sum(categories.values()) or 1
+
+        self._lgr.logger.info(
+            'Profile of %s: wall time %.3fs, self time by category over '
+            'all threads %s', stage, self._wall_times[stage],
+            ', '.join(f'{category} {seconds:.3f}s '
+                      f'({seconds / total * 100:.0f}%)'
+                      for category, seconds in sorted(categories.items(),
+                                        key=lambda item: -item[1])))
+
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self._top)
+
+        self._lgr.logger.info('Top %d functions of %s by cumulative time\n%s',
+            self._top, stage, output.getvalue().strip('\n'))
+
+    def _log_allocations(self, stage: str=None) -> None:
+        """ Log peak traced memory and top allocation sites of the stage """
+
+        peak, statistics = self._allocations[stage]
+
+        self._lgr.logger.info(
+            'Allocations of %s: peak %.1f MiB, top %d sites alive at the end '
+            'of the stage\n%s', stage, peak / (1 << 20), len(statistics),
+            '\n'.join(f'{statistic.size / 1024:10.1f} KiB '
+                      f'{statistic.count:8d} blocks  '
+                      f'{statistic.traceback[0]}'
+                      for statistic in statistics))
+
+    def finish(self) -> None:
+        """ Dump the merged profile and log the per-stage summary """
+
+        threading.setprofile(None)
+
+        for stage in self._wall_times:
+            if self._profiles.get(stage):
+                self._log_profile(stage,
+                                    self._make_stats(self._profiles[stage]))
+            if stage in self._allocations:
+                self._log_allocations(stage)
+
+        profiles = [profile for stage_profiles in self._profiles.values()
+                        for profile in stage_profiles]
+
+        if self._profile_file is not None and profiles:
+            self._make_stats(profiles).dump_stats(self._profile_file)
+
+            self._lgr.logger.info('Please find the profile\n\t- %s',
+                Path(self._profile_file).resolve())
+
+        if self._trace_alloc:
+            tracemalloc.stop()
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
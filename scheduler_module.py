@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Scheduler Module """
+
+import random
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from collections.abc import Callable
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                TimeoutError as FutureTimeoutError, wait)
+import requests
+from logger_module import Logger
+
+# Callback of a request attempt with its response or error and latency
+AttemptCallback = Callable[
+    [requests.Response | None, Exception | None, float], None]
+
+class TokenBucket:
+    """ Token bucket rate limiter, a rate of 0 disables the limit """
+
+    def __init__(self, rate: float=0, burst: int=1) -> None:
+        self._rate = rate
+        self._capacity = max(1, burst)
+        self._tokens = float(self._capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """ Wait for a token """
+
+        if self._rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens
+                                    + (now - self._updated) * self._rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                delay = (1 - self._tokens) / self._rate
+
+            time.sleep(delay)
+
+    def try_acquire(self) -> bool:
+        """ Take a token if one is available right now """
+
+        if self._rate <= 0:
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens
+                                + (now - self._updated) * self._rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+
+        return False
+
+class RequestScheduler:
+    """
+    Schedule upstream requests with retries, rate and concurrency control
+
+    Retryable failures (connection errors, timeouts, 429 and 5xx responses)
+    are retried with exponential backoff and full jitter. The number of
+    requests in flight follows AIMD: it grows by one per window of healthy
+    responses up to the maximum and is halved when upstream responds with
+    errors or slower than the latency target
+
+    Hedged requests, if enabled, are duplicated once they take longer than
+    the given percentile of latencies recently observed for the same
+    endpoint, and the first successful response wins. Hedges are only sent
+    within the budget share of extra requests
+    """
+
+    _retryable_status = (429, 500, 502, 503, 504)
+    _hedge_min_samples = 20
+
+    def __init__(self, max_concurrency: int=8, rate: float=0,
+                    retries: int=3, backoff: float=0.5,
+                    backoff_max: float=30, latency_target: float=2,
+                    hedge_percentile: float=0, hedge_budget: float=10,
+                    loglevel: int=20) -> None:
+
+        self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
+        self._max_concurrency = max(1, max_concurrency)
+        self._limit = float(self._max_concurrency)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._last_decrease = 0.0
+        self._bucket = TokenBucket(rate=rate, burst=max(1, int(rate)))
+        self._retries = max(0, retries)
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        self._latency_target = latency_target
+        self._hedge_percentile = hedge_percentile
+        self._hedge_budget = hedge_budget / 100
+        self._latencies: dict[str, deque[float]] = defaultdict(
+                                                lambda: deque(maxlen=256))
+        self._sent = 0
+        self._hedged = 0
+        self._hedge_executor = None
+
+        if hedge_percentile > 0:
+            self._hedge_executor = ThreadPoolExecutor(
+                                    max_workers=2 * self._max_concurrency,
+                                    thread_name_prefix='hedge')
+
+    def _acquire(self) -> None:
+        """ Wait for a free request slot within the current limit """
+
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+            self._sent += 1
+
+    def _try_acquire_hedge(self) -> bool:
+        """
+        Take an extra request slot for a hedge within the budget. Hedges
+        may go above the concurrency limit, the budget caps the extra load
+        """
+
+        with self._condition:
+            if self._hedged >= self._hedge_budget * self._sent:
+                return False
+
+            if not self._bucket.try_acquire():
+                return False
+
+            self._in_flight += 1
+            self._hedged += 1
+
+        return True
+
+    def _release(self, healthy: bool=True, latency: float=0,
+                    endpoint: str=None) -> None:
+        """ Free the request slot and adapt the limit """
+
+        with self._condition:
+            self._in_flight -= 1
+
+            if healthy:
+                self._latencies[endpoint].append(latency)
+
+            if healthy and latency <= self._latency_target:
+                self._limit = min(self._max_concurrency,
+                                    self._limit + 1 / self._limit)
+            else:
+                now = time.monotonic()
+
+                # Decrease once per latency window, not on every response
+                # of the same congested batch
+                if now - self._last_decrease > max(latency, 1):
+                    self._limit = max(1.0, self._limit / 2)
+                    self._last_decrease = now
+
+                    self._lgr.logger.info(
+                        'Decrease concurrency to %d', int(self._limit))
+
+            self._condition.notify_all()
+
+    def _get_delay(self, attempt: int=None,
+                    response: requests.Response=None) -> float:
+        """ Return backoff delay before the next attempt """
+
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(self._backoff_max, int(retry_after))
+
+        return random.uniform(
+                    0, min(self._backoff_max, self._backoff * 2 ** attempt))
+
+    def _get_hedge_delay(self, endpoint: str=None) -> float | None:
+        """
+        Return latency percentile observed for the endpoint to hedge after,
+        None until enough latencies are observed
+        """
+
+        with self._condition:
+            latencies = sorted(self._latencies[endpoint])
+
+        if len(latencies) < self._hedge_min_samples:
+            return None
+
+        return latencies[int(self._hedge_percentile / 100
+                                * (len(latencies) - 1))]
+
+    def _is_retryable(self, response: requests.Response=None,
+                        error: Exception=None) -> bool:
+        """ Check the request outcome is worth a retry """
+
+        return (error is not None
+                or response.status_code in self._retryable_status)
+
+    def _send(self, send: Callable[[], requests.Response]=None,
+                endpoint: str=None, on_attempt: AttemptCallback=None
+                ) -> tuple[requests.Response | None, Exception | None]:
+        """
+        Send request within an acquired slot, return response or retryable
+        error, free the slot once done. The attempt outcome and its own
+        latency are passed to the callback if set
+        """
+
+        started = time.monotonic()
+        response = error = None
+
+        try:
+            response = send()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as err:
+            error = err
+        except BaseException as err:
+            self._release(healthy=False, endpoint=endpoint)
+            if on_attempt is not None and isinstance(err, Exception):
+                on_attempt(None, err, time.monotonic() - started)
+            raise
+
+        latency = time.monotonic() - started
+        self._release(healthy=not self._is_retryable(response, error),
+                        latency=latency,
+                        endpoint=endpoint)
+
+        if on_attempt is not None:
+            on_attempt(response, error, latency)
+
+        return response, error
+
+    def _send_hedged(self, send: Callable[[], requests.Response]=None,
+                        description: str=None, endpoint: str=None,
+                        on_attempt: AttemptCallback=None
+                        ) -> tuple[requests.Response | None, Exception | None]:
+        """
+        Send request within an acquired slot and duplicate it if it is slower
+        than the hedge percentile, return the first successful outcome
+        """
+
+        delay = self._get_hedge_delay(endpoint)
+        primary = self._hedge_executor.submit(self._send, send, endpoint,
+                                                on_attempt)
+
+        if delay is None:
+            return primary.result()
+
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+
+        if not self._try_acquire_hedge():
+            return primary.result()
+
+        self._lgr.logger.debug('Hedge %s after %.3fs', description, delay)
+
+        pending = {primary,
+                    self._hedge_executor.submit(self._send, send, endpoint,
+                                                on_attempt)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                response, error = future.result()
+                if not self._is_retryable(response, error):
+                    return response, error
+
+        return response, error
+
+    def execute(self, send: Callable[[], requests.Response]=None,
+                description: str=None,
+                hedge: bool=False,
+                endpoint: str=None,
+                on_attempt: AttemptCallback=None) -> requests.Response:
+        """
+        Send request with retries, return the last response or raise the
+        last error once retries are exhausted. Idempotent requests may be
+        hedged, latencies are tracked per endpoint to hedge after. Every
+        attempt, retries and hedges included, is reported to the callback
+        with its response or error and latency
+        """
+
+        for attempt in range(self._retries + 1):
+            self._bucket.acquire()
+            self._acquire()
+
+            if hedge and self._hedge_executor is not None:
+                response, error = self._send_hedged(send, description,
+                                                    endpoint, on_attempt)
+            else:
+                response, error = self._send(send, endpoint, on_attempt)
+
+            if not self._is_retryable(response, error):
+                return response
+
+            if attempt == self._retries:
+                break
+
+            delay = self._get_delay(attempt, response)
+            self._lgr.logger.warning(
+                'Retry %s in %.1fs (%d/%d): %s',
+                description, delay, attempt + 1, self._retries,
+                error if error is not None else response.status_code)
+            time.sleep(delay)
+
+        if error is not None:
+            raise error
+
+        return response
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: Server Module """
+
+import gzip
+import hashlib
+import re
+import sys
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger_module import Logger
+
+@dataclass(frozen=True)
+class RenderedDocument:
+    """
+    Pre-rendered document served from memory
+
+    Attributes
+    ----------
+    content_type: str
+        MIME type of the document
+    content: bytes
+        Document body
+    content_gzip: bytes
+        Gzip compressed document body
+    etag: str
+        Entity tag of the document body
+    etag_gzip: str
+        Entity tag of the gzip compressed document body
+    last_modified: float
+        Unix epoch timestamp of the document rendering
+    """
+
+    content_type: str = None
+    content: bytes = None
+    content_gzip: bytes = None
+    etag: str = None
+    etag_gzip: str = None
+    last_modified: float = None
+
+    @classmethod
+    def from_text(cls, content_type: str=None, text: str=None,
+                    last_modified: float=None,
+                    volatile: re.Pattern=None) -> 'RenderedDocument':
+        """
+        Encode and compress rendered text document, the first match of the
+        volatile pattern is left out of the entity tags
+        """
+
+        content = text.encode('utf8')
+        if volatile is not None:
+            text = volatile.sub('', text, 1)
+        digest = hashlib.sha256(text.encode('utf8')).hexdigest()[:32]
+
+        return cls(
+            content_type=content_type,
+            content=content,
+            content_gzip=gzip.compress(content, compresslevel=6, mtime=0),
+            etag=f'"{digest}"',
+            etag_gzip=f'"{digest}-gz"',
+            last_modified=last_modified
+        )
+
+class LiveTVRequestHandler(BaseHTTPRequestHandler):
+    """ Serve pre-rendered documents of the LiveTV server """
+
+    server_version = 'SmotreshkaLiveTVRipper'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format: str, *args) -> None: # pylint: disable=redefined-builtin
+        self.server.livetv.lgr.logger.debug(
+            '%s %s', self.address_string(), format % args)
+
+    def _send_empty(self, status: int=None, headers: dict=None) -> None:
+        """ Send response without body """
+
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _is_not_modified(self, document: RenderedDocument=None,
+                            etag: str=None) -> bool:
+        """
+        Check conditional request headers against the document and the
+        entity tag of its representation
+        """
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in (
+                tag.strip() for tag in if_none_match.split(','))
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                return int(document.last_modified) <= parsedate_to_datetime(
+                                            if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+        return False
+
+    def _redirect_stream(self, channel_id: str=None) -> None:
+        """ Redirect to media stream of the channel resolved on demand """
+
+        try:
+            url = self.server.livetv.resolver(channel_id)
+
+        except KeyError:
+            self._send_empty(404)
+            return
+
+        # Smotreshka exits on unrecoverable errors, keep serving instead
+        except (Exception, SystemExit) as err: # pylint: disable=broad-exception-caught
+            self.server.livetv.lgr.logger.error(
+                'Cannot resolve LiveTV stream of channel `%s`: %r',
+                channel_id, err)
+            url = None
+
+        if url is None:
+            self._send_empty(502)
+        else:
+            self._send_empty(302, {
+                'Location': url,
+                'Cache-Control': 'no-store'
+            })
+
+    def do_HEAD(self) -> None: # pylint: disable=invalid-name
+        """ Serve document headers """
+
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body: bool=True) -> None: # pylint: disable=invalid-name
+        """ Serve document """
+
+        documents = self.server.livetv.documents
+        path = self.path.split('?', 1)[0]
+
+        if (path.startswith('/stream/')
+            and self.server.livetv.resolver is not None):
+            self._redirect_stream(path.removeprefix('/stream/'))
+            return
+
+        if path not in self.server.livetv.paths:
+            self._send_empty(404)
+            return
+
+        document = documents.get(path)
+        if document is None:
+            self._send_empty(503, {'Retry-After': '30'})
+            return
+
+        content, etag = document.content, document.etag
+        headers = {
+            'Last-Modified': formatdate(document.last_modified, usegmt=True),
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content, etag = document.content_gzip, document.etag_gzip
+            headers['Content-Encoding'] = 'gzip'
+        headers['ETag'] = etag
+
+        if self._is_not_modified(document, etag):
+            headers.pop('Content-Encoding', None)
+            self._send_empty(304, headers)
+            return
+
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', document.content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        if send_body:
+            self.wfile.write(content)
+
+class LiveTVServer:
+    """
+    HTTP server serving LiveTV documents from memory
+
+    The documents are rendered by the refresher callable in a background
+    thread on a schedule, and swapped in at once when ready. Requests are
+    always served from the last rendered documents and never wait for the
+    refresh. Entity tags leave out the volatile pattern of the path, and a
+    document unchanged but for it is kept as previously rendered, so its
+    entity tag and modification time hold across refreshes
+
+    With the resolver callable set, /stream/{channel_id} requests are
+    redirected to the media stream URL it returns, the resolver raises
+    KeyError for channels not in the playlist
+    """
+
+    def __init__(self, host: str='127.0.0.1', port: int=8080,
+                    refresher: Callable[[], dict[str, tuple[str, str]]]=None,
+                    resolver: Callable[[str], str | None]=None,
+                    paths: tuple[str, ...]=(),
+                    volatile: dict[str, re.Pattern]=None,
+                    interval: int=3600, loglevel: int=20) -> None:
+
+        self.lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
+        self.documents: dict[str, RenderedDocument] = {}
+        self.paths = paths
+        self.volatile = volatile or {}
+        self.resolver = resolver
+        self._refresher = refresher
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._httpd = ThreadingHTTPServer((host, port), LiveTVRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.livetv = self
+
+    def refresh(self) -> None:
+        """ Render documents and swap them in """
+
+        self.lgr.logger.info('Refresh LiveTV documents')
+
+        try:
+            rendered = self._refresher()
+
+        # Smotreshka exits on unrecoverable errors, keep serving instead
+        except (Exception, SystemExit) as err: # pylint: disable=broad-exception-caught
+            self.lgr.logger.error(
+                'Cannot refresh LiveTV documents, keep serving previous '
+                'ones: %r', err)
+            return
+
+        now = time.time()
+        documents = {}
+        for path, (content_type, text) in rendered.items():
+            document = RenderedDocument.from_text(content_type, text, now,
+                                                    self.volatile.get(path))
+            previous = self.documents.get(path)
+            if previous is not None and previous.etag == document.etag:
+                document = previous
+            documents[path] = document
+        self.documents = self.documents | documents
+
+        self.lgr.logger.info('Refreshed LiveTV documents %s',
+            ', '.join(documents))
+
+    def _refresh_loop(self) -> None:
+        """ Refresh documents until stopped """
+
+        while not self._stopped.is_set():
+            self.refresh()
+            self._stopped.wait(self._interval)
+
+    def serve_forever(self) -> None:
+        """ Start background refresh and serve requests until interrupted """
+
+        refresh_thread = threading.Thread(target=self._refresh_loop,
+                                            name='refresher', daemon=True)
+        refresh_thread.start()
+
+        host, port = self._httpd.server_address[:2]
+        self.lgr.logger.info('Serve %s on http://%s:%s',
+            ', '.join(self.paths), host, port)
+
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            self.lgr.logger.info('Stop serving')
+        finally:
+            self._stopped.set()
+            self._httpd.server_close()
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)
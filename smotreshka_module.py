@@ -2,23 +2,90 @@
 """ Smotreshka LiveTV Ripper: Smotreshka Module """
 
 import json
+import logging
 import sys
 import random
+import itertools
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from batch_module import EPGShare
+from cache_module import ResponseCache
+from epg_module import EPGProgramEntry
+from filter_module import ChannelFilter
 from logger_module import Logger
+from metrics_module import RunMetrics
+from output_module import atomic_open
+from parser_module import PARSE_ERRORS, PROGRAMS_PARSER, in_window, \
+                            parse_programs
+from scheduler_module import RequestScheduler
+from state_module import EPGState
 
 class Smotreshka:
     """ Class to handle initial Smotreshka M3U and EPG data """
 
     def __init__(self, username: str=None, password: str=None,
-                    limit: int=0, mode: str='all', loglevel: int=20) -> None:
+                    limit: int=0, mode: str='all', concurrency: int=8,
+                    prefetch: bool=True, cache: ResponseCache=None,
+                    epg_state: EPGState=None, stream_base_url: str=None,
+                    stream_ttl: int=300, session_file: str=None,
+                    rate_limit: float=0, retries: int=3, timeout: float=60,
+                    hedge_percentile: float=0, hedge_budget: float=10,
+                    base_url: str='https://fe.smotreshka.tv',
+                    metrics: RunMetrics=None, epg_from: float=None,
+                    epg_days: float=None, channel_filter: ChannelFilter=None,
+                    adapter: HTTPAdapter=None,
+                    scheduler: RequestScheduler=None,
+                    epg_share: EPGShare=None, loglevel: int=20) -> None:
 
         self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
         self._channels = {}
         self._channels_limit = limit
+        self._channel_filter = channel_filter
+        self._channels_fresh = False
+        self._epg_share = epg_share
+        self._mode = mode
+        self._concurrency = max(1, concurrency)
+        self._cache = cache
+        self._epg_state = epg_state
+        self._epg_from = epg_from
+        self._epg_days = epg_days
+        self._epg_window = None
+        self._stream_base_url = stream_base_url
+        self._stream_ttl = stream_ttl
+        self._stream_urls: dict[str, tuple[str, float]] = {}
+        self._stream_urls_lock = threading.Lock()
+        self._session_file = Path(session_file) if session_file else None
+        self._login_generation = 0
+        self._login_lock = threading.Lock()
+        self._timeout = timeout
+        self._metrics = metrics or RunMetrics(loglevel=loglevel)
+        self._scheduler = scheduler or RequestScheduler(
+                                max_concurrency=self._concurrency,
+                                rate=rate_limit,
+                                retries=retries,
+                                hedge_percentile=hedge_percentile,
+                                hedge_budget=hedge_budget,
+                                loglevel=loglevel)
+
+        # Hedged requests may double the number of connections in use
+        pool_maxsize = self._concurrency * (2 if hedge_percentile > 0 else 1)
         self._session = requests.Session()
-        self._base_url = 'https://fe.smotreshka.tv'
+        # Sessions of several accounts may share the adapter and its
+        # connection pool, cookies are kept per session
+        self._session.mount('https://', adapter or HTTPAdapter(
+                                        pool_connections=1,
+                                        pool_maxsize=pool_maxsize))
+        self._session.mount('http://', adapter or HTTPAdapter(
+                                        pool_connections=1,
+                                        pool_maxsize=pool_maxsize))
+        self._base_url = base_url.rstrip('/')
         self._user_agent = random.choice([
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTM'
             'L, like Gecko) Chrome/105.0.0.0 Safari/537.36 Edg/105.0.1343.33'
@@ -40,65 +107,153 @@ class Smotreshka:
             # sysexits.h: EX_DATAERR
             sys.exit(65)
 
-        self._login()
+        self._lgr.logger.debug('Parse EPG programs with %s', PROGRAMS_PARSER)
+
+        if not self._load_session():
+            self._login()
+
         self._collect_channels()
 
-        if mode in ('all', 'epg'):
-            self._collect_epg()
-        if mode in ('all', 'm3u'):
-            self._collect_streams()
+        if prefetch:
+            self._collect_all()
 
     def __str__(self) -> str:
         """ Human readable print of the current class """
 
-        return json.dumps(self._channels, ensure_ascii=False, indent=4)
+        return json.dumps(self._channels, ensure_ascii=False, indent=4,
+                            default=EPGProgramEntry.make_dict)
 
     def _http_request(self, method: str=None, url: str=None,
-                        headers: dict=None, data: dict=None) -> dict:
-        """ Request endpoint using REST """
+                        headers: dict=None, data: dict=None,
+                        endpoint: str=None, fatal: bool=True,
+                        hedge: bool=False) -> dict:
+        """
+        Request API endpoint using REST
+
+        GET requests to a named endpoint go through the response cache
+        if it is enabled. Requests to a named endpoint rejected as not
+        authorized are repeated once after login. Failed non-fatal requests
+        return None instead of exiting. Hedge is only allowed for idempotent
+        requests
+        """
+
+        cacheable = (self._cache is not None
+                        and method == 'GET' and endpoint is not None)
+
+        if cacheable:
+            cached_response, conditional_headers = self._cache.lookup(
+                                                                url, endpoint)
+            if cached_response is not None:
+                self._metrics.observe_cache_hit(endpoint)
+                return cached_response
+
+            headers = (headers or {}) | conditional_headers
+
+        login_generation = self._login_generation
+        response = self._send_request(method, url, headers, data, fatal,
+                                            hedge, endpoint)
+
+        if response is None:
+            return None
+
+        if (endpoint is not None
+            and response.status_code in (requests.codes.unauthorized, # pylint: disable=no-member
+                                         requests.codes.forbidden)): # pylint: disable=no-member
+            self._lgr.logger.warning(
+                'Not authorized to request %s: %s, login again',
+                url, response.status_code)
+
+            self._relogin(login_generation)
+            response = self._send_request(method, url, headers, data, fatal,
+                                            hedge, endpoint)
+
+            if response is None:
+                return None
+
+        if cacheable:
+            if response.status_code == requests.codes.not_modified: # pylint: disable=no-member
+                return self._cache.revalidated(url) or response
+
+            self._cache.store(url, response)
+
+        return response
+
+    def _send_request(self, method: str=None, url: str=None,
+                        headers: dict=None, data: dict=None,
+                        fatal: bool=True, hedge: bool=False,
+                        endpoint: str=None) -> dict:
+        """
+        Send request over the session through the request scheduler and
+        record each attempt to the run metrics, unnamed endpoint is the login
+        """
 
         self._lgr.logger.debug('Request %s %s Params=%s', method, url, data)
 
+        endpoint = endpoint or 'login'
+
+        def observe_attempt(response: requests.Response | None,
+                            error: Exception | None, latency: float) -> None:
+            """ Record the attempt to the run metrics """
+
+            if error is not None:
+                self._metrics.observe_request(endpoint, 'error',
+                                                latency=latency)
+            else:
+                self._metrics.observe_request(endpoint, response.status_code,
+                                                len(response.content), latency)
+
         try:
-            response = self._session.request(
-                method=method,
-                url=url,
-                headers=headers,
-                data=data,
-                timeout=60
+            response = self._scheduler.execute(
+                lambda: self._session.request(
+                    method=method,
+                    url=url,
+                    headers=headers,
+                    data=data,
+                    timeout=self._timeout
+                ),
+                description=f'{method} {url}',
+                hedge=hedge,
+                endpoint=endpoint,
+                on_attempt=observe_attempt
             )
-            return response
 
-        except requests.exceptions.HTTPError as errh:
-            self._lgr.logger.critical(
-                'Failed to get response from %s. HTTP error %s', url, errh)
+        except requests.exceptions.RequestException as err:
+            if not fatal:
+                self._lgr.logger.warning(
+                    'Failed to get response from %s. Error %s', url, err)
 
-            # sysexits.h: EX_DATAERR
-            sys.exit(65)
+                return None
 
-        except requests.exceptions.ConnectionError as errc:
-            self._lgr.logger.critical(
-                'Failed to get response from %s. Connection error %s', url, errc
-                )
+            if isinstance(err, requests.exceptions.HTTPError):
+                self._lgr.logger.critical(
+                    'Failed to get response from %s. HTTP error %s', url, err)
 
-            # sysexits.h: EX_UNAVAILABLE
-            sys.exit(69)
+                # sysexits.h: EX_DATAERR
+                sys.exit(65)
 
-        except requests.exceptions.Timeout as errt:
-            self._lgr.logger.critical(
-                'Failed to get response from %s. Timeout error %s', url, errt)
+            if isinstance(err, requests.exceptions.ConnectionError):
+                self._lgr.logger.critical(
+                    'Failed to get response from %s. Connection error %s',
+                    url, err)
 
-            # sysexits.h: EX_UNAVAILABLE
-            sys.exit(69)
+                # sysexits.h: EX_UNAVAILABLE
+                sys.exit(69)
+
+            if isinstance(err, requests.exceptions.Timeout):
+                self._lgr.logger.critical(
+                    'Failed to get response from %s. Timeout error %s',
+                    url, err)
+
+                # sysexits.h: EX_UNAVAILABLE
+                sys.exit(69)
 
-        except requests.exceptions.RequestException as errg:
             self._lgr.logger.exception(
-                'Failed to get response from %s. Error %s', url, errg)
+                'Failed to get response from %s. Error %s', url, err)
 
             # sysexits.h: EX_OSERR
             sys.exit(71)
 
-        return None
+        return response
 
     def _login(self) -> None:
         """ Login to Smotreshka """
@@ -106,15 +261,16 @@ class Smotreshka:
         self._lgr.logger.info(
             'Login as user %s', self._smotreshka_username)
 
-        response_login = self._http_request(
-                method='POST',
-                url=f'{self._base_url}/login',
-                headers={'User-Agent': self._user_agent},
-                data={
-                    'email': self._smotreshka_username,
-                    'password': self._smotreshka_password,
-                }
-            )
+        with self._metrics.stage('login'):
+            response_login = self._http_request(
+                    method='POST',
+                    url=f'{self._base_url}/login',
+                    headers={'User-Agent': self._user_agent},
+                    data={
+                        'email': self._smotreshka_username,
+                        'password': self._smotreshka_password,
+                    }
+                )
 
         if (response_login is None
             or response_login.status_code != requests.codes.ok): # pylint: disable=no-member
@@ -133,19 +289,80 @@ class Smotreshka:
                                 self._session.cookies)
                             )
 
+            self._login_generation += 1
+            self._save_session()
+
+    def _relogin(self, login_generation: int=None) -> None:
+        """ Login again unless another request already did it """
+
+        with self._login_lock:
+            if self._login_generation == login_generation:
+                self._session.cookies.clear()
+                self._login()
+
+    def _load_session(self) -> bool:
+        """ Restore session cookies saved by the previous run """
+
+        if self._session_file is None or not self._session_file.exists():
+            return False
+
+        try:
+            session_state = json.loads(
+                            self._session_file.read_text(encoding='utf8'))
+        except (OSError, ValueError) as err:
+            self._lgr.logger.warning(
+                'Cannot load session file %s: %s', self._session_file, err)
+            return False
+
+        if (session_state.get('username') != self._smotreshka_username
+            or not session_state.get('cookies')):
+            return False
+
+        for cookie in session_state.get('cookies'):
+            self._session.cookies.set(**cookie)
+
+        self._lgr.logger.info(
+            'Reuse saved session of user %s', self._smotreshka_username)
+
+        return True
+
+    def _save_session(self) -> None:
+        """ Save session cookies to be reused by the next run """
+
+        if self._session_file is None:
+            return
+
+        with atomic_open(file=self._session_file,
+                            permissions=0o600) as session_file:
+            json.dump({
+                'username': self._smotreshka_username,
+                'cookies': [
+                    {
+                        'name': cookie.name,
+                        'value': cookie.value,
+                        'domain': cookie.domain,
+                        'path': cookie.path
+                    } for cookie in self._session.cookies
+                ]
+            }, session_file)
+
+        self._lgr.logger.debug('Saved session to %s', self._session_file)
+
     def _collect_channels(self) -> None:
         """ Collect purchased LiveTV channels """
 
         self._lgr.logger.info('Collect purchased LiveTV channels')
 
-        response_channels = self._http_request(
-                method='GET',
-                url=f'{self._base_url}/channels',
-                headers={
-                    'User-Agent': self._user_agent,
-                    'Accept': 'application/json'
-                }
-        )
+        with self._metrics.stage('channels'):
+            response_channels = self._http_request(
+                    method='GET',
+                    url=f'{self._base_url}/channels',
+                    headers={
+                        'User-Agent': self._user_agent,
+                        'Accept': 'application/json'
+                    },
+                    endpoint='channels'
+            )
 
         if (response_channels is None
             or response_channels.status_code != requests.codes.ok): # pylint: disable=no-member
@@ -157,6 +374,7 @@ class Smotreshka:
             sys.exit(71)
 
         else:
+            channels = {}
             channels_limit = 1
             response_channels_json = response_channels.json()
 
@@ -178,9 +396,19 @@ class Smotreshka:
                                             'mediaInfo').get('thumbnails')[
                                 0].get('url')
 
+                        # Excluded channels do not count towards the limit
+                        if (self._channel_filter
+                            and not self._channel_filter.is_selected(
+                                channel_id, int(channel_number),
+                                channel_title, channel_groups)):
+
+                            self._lgr.logger.debug('Skip channel `%s`',
+                                channel_title)
+                            continue
+
                         self._lgr.logger.info('Add channel `%s`', channel_title)
 
-                        self._channels[channel_id] = {
+                        channels[channel_id] = {
                             'number': int(channel_number),
                             'title': channel_title,
                             'groups': channel_groups,
@@ -188,219 +416,507 @@ class Smotreshka:
                             'language': 'ru_RU' # default language
                         }
 
+                        if self._stream_base_url is not None:
+                            channels[channel_id]['url'] = \
+                                f'{self._stream_base_url}/stream/{channel_id}'
+
                     if (self._channels_limit > 0
                         and channels_limit >= self._channels_limit):
                         break
                     channels_limit += 1
 
-                if len(self._channels) < 1:
+                if len(channels) < 1:
                     self._lgr.logger.critical(
                     'Did not collect at least one purchased LiveTV channel')
 
                     # sysexits.h: EX_DATAERR
                     sys.exit(65)
+
+                self._channels = channels
+                self._channels_fresh = True
             else:
                 self._lgr.logger.critical('List of LiveTV channels is empty')
 
                 # sysexits.h: EX_DATAERR
                 sys.exit(65)
 
-    def _collect_streams(self) -> None:
-        """ Enrich LiveTV channels with media streams """
+    def _get_collectors(self) -> tuple:
+        """
+        Return per-channel collectors required by the generator mode along
+        with their metrics stage names
+        """
+
+        collectors = ()
+
+        if self._mode in ('all', 'epg'):
+            collectors += (('epg_fetch', self._collect_channel_epg),)
+        if self._mode in ('all', 'm3u') and self._stream_base_url is None:
+            collectors += (('stream_fetch', self._collect_channel_stream),)
+
+        return collectors
+
+    def _get_epg_window(self) -> tuple[float | None, float | None] | None:
+        """
+        Return EPG time window to keep programs within, it starts now if
+        only the number of days is set
+        """
+
+        if self._epg_from is None and self._epg_days is None:
+            return None
+
+        window_start = self._epg_from
+        if window_start is None:
+            window_start = time.time()
+
+        window_stop = None
+        if self._epg_days is not None:
+            window_stop = window_start + self._epg_days * 86400
+
+        return window_start, window_stop
+
+    def _run_collector(self, stage: str=None, collector=None,
+                        channel_id: str=None, channel_data: dict=None) -> None:
+        """ Run per-channel collector accounting its time to the stage """
+
+        with self._metrics.stage(stage):
+            collector(channel_id, channel_data)
+
+    def _collect_all(self) -> None:
+        """ Run per-channel collectors over all channels """
+
+        for _ in self._iter_collected():
+            pass
+
+    def _iter_collected(self) -> Iterator[tuple[str, dict]]:
+        """
+        Run per-channel collectors in a worker pool and yield channels in
+        channel order as soon as all their collectors are done. The number
+        of channels in flight is bounded to keep memory usage flat
+        """
+
+        collectors = self._get_collectors()
+        window = self._concurrency * 4
+        self._epg_window = self._get_epg_window()
+        if self._epg_state is not None:
+            self._epg_state.start_collection()
+        channels = iter(self._channels.items())
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self._concurrency,
+                                thread_name_prefix='collector') as executor:
+            try:
+                while True:
+                    for channel_id, channel_data in itertools.islice(
+                                            channels, window - len(pending)):
+                        pending.append((channel_id, channel_data, [
+                            executor.submit(self._run_collector, stage,
+                                            collector, channel_id, channel_data)
+                            for stage, collector in collectors
+                        ]))
+
+                    if not pending:
+                        break
 
-        for channel_id, channel_data in self._channels.items():
-            self._lgr.logger.info('Collect LiveTV stream `%s` (%s)',
-                channel_id,
-                channel_data['title'])
+                    channel_id, channel_data, futures = pending.popleft()
+                    for future in futures:
+                        future.result()
 
-            response_channel = self._http_request(
-                    method='GET',
-                    url=f'{self._base_url}/playback-info/'
-                            f'{channel_id}',
-                    headers={
-                        'User-Agent': self._user_agent,
-                        'Accept': 'application/json'
-                    }
-                )
-            if (response_channel is None
-                or response_channel.status_code != requests.codes.ok): # pylint: disable=no-member
+                    yield channel_id, channel_data
 
-                self._lgr.logger.warning('Cannot collect LiveTV streams for '
-                        'channel `%s` (%s): error %s',
-                        channel_id,
-                        channel_data['title'],
-                        response_channel.status_code
-                        )
-            else:
-                response_channel_json = response_channel.json()
+                if self._epg_state is not None and self._mode in ('all', 'epg'):
+                    self._epg_state.save()
 
-                if ('languages' in response_channel_json
-                    and len(response_channel_json.get('languages')) > 0):
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
 
-                    for language in response_channel_json.get('languages'):
+    def _collect_channel_stream(self, channel_id: str=None,
+                                    channel_data: dict=None) -> None:
+        """ Enrich LiveTV channel with media stream """
 
-                        if language.get('default'):
+        self._lgr.logger.info('Collect LiveTV stream `%s` (%s)',
+            channel_id,
+            channel_data['title'])
 
-                            channel_lang = language.get('id').replace('-', '_')
+        response_channel = self._http_request(
+                method='GET',
+                url=f'{self._base_url}/playback-info/'
+                        f'{channel_id}',
+                headers={
+                    'User-Agent': self._user_agent,
+                    'Accept': 'application/json'
+                },
+                endpoint='playback-info',
+                fatal=False,
+                hedge=True
+            )
+        if (response_channel is None
+            or response_channel.status_code != requests.codes.ok): # pylint: disable=no-member
 
-                            self._lgr.logger.info(
-                                'Add language %s to channel `%s` (%s)',
-                                channel_lang,
-                                channel_id,
-                                channel_data['title'])
+            self._metrics.count_error('stream_fetch')
+            self._lgr.logger.warning('Cannot collect LiveTV streams for '
+                    'channel `%s` (%s): error %s',
+                    channel_id,
+                    channel_data['title'],
+                    response_channel.status_code
+                        if response_channel is not None else 'no response'
+                    )
+        else:
+            try:
+                self._parse_channel_stream(channel_id, channel_data,
+                                            response_channel.json())
+            except PARSE_ERRORS as err:
+                self._metrics.count_error('stream_parse')
+                self._lgr.logger.warning('Cannot parse LiveTV streams for '
+                        'channel `%s` (%s): %s',
+                        channel_id,
+                        channel_data['title'],
+                        err)
 
-                            channel_data['language'] = channel_lang
+    def _parse_channel_stream(self, channel_id: str=None,
+                                channel_data: dict=None,
+                                response_channel_json: dict=None) -> None:
+        """ Pick language and media stream URL of the playback info """
 
-                            if len(language.get('renditions')) > 0:
-                                for rendition in language.get('renditions'):
+        if ('languages' in response_channel_json
+            and len(response_channel_json.get('languages')) > 0):
 
-                                    if (rendition.get('default')
-                                        and rendition.get('id') == 'Auto'):
+            for language in response_channel_json.get('languages'):
 
-                                        self._lgr.logger.info(
-                                            'Add LiveTV stream URL to ' \
-                                            'channel `%s` (%s)',
-                                            channel_id,
-                                            channel_data['title'])
+                if language.get('default'):
 
-                                        channel_data['url']=rendition.get('url')
-                                    else:
+                    channel_lang = language.get('id').replace('-', '_')
 
-                                        self._lgr.logger.warning(
-                                            'Cannot collect default LiveTV'
-                                            'rendition for channel `%s` (%s)',
-                                            channel_id,
-                                            channel_data['title'])
+                    self._lgr.logger.info(
+                        'Add language %s to channel `%s` (%s)',
+                        channel_lang,
+                        channel_id,
+                        channel_data['title'])
 
-                                        self._lgr.logger.info(
-                                            'Add first found LiveTV stream '
-                                            'URL to channel `%s` (%s)',
-                                            channel_id,
-                                            channel_data['title'])
+                    channel_data['language'] = channel_lang
 
-                                        channel_data['url']=language.get(
-                                                    'renditions')[0].get('url')
+                    if len(language.get('renditions')) > 0:
+                        for rendition in language.get('renditions'):
 
-                                    break
+                            if (rendition.get('default')
+                                and rendition.get('id') == 'Auto'):
+
+                                self._lgr.logger.info(
+                                    'Add LiveTV stream URL to ' \
+                                    'channel `%s` (%s)',
+                                    channel_id,
+                                    channel_data['title'])
+
+                                channel_data['url']=rendition.get('url')
                             else:
+
                                 self._lgr.logger.warning(
-                                    'Cannot collect renditions for channel '
-                                    '`%s` (%s)',
+                                    'Cannot collect default LiveTV'
+                                    'rendition for channel `%s` (%s)',
                                     channel_id,
                                     channel_data['title'])
-                        else:
-
-                            channel_lang = language.get('id').replace('-', '_')
-
-                            self._lgr.logger.info(
-                                'Add language %s to channel `%s` (%s)',
-                                channel_lang,
-                                channel_id,
-                                channel_data['title'])
-
-                            channel_data['language'] = channel_lang
-
-                            self._lgr.logger.warning(
-                                'Cannot collect default LiveTV '
-                                'rendition for channel `%s` (%s)',
-                                channel_id,
-                                channel_data['title'])
-                            self._lgr.logger.info(
-                                'Add first found LiveTV stream '
-                                'URL to channel `%s` (%s)',
-                                channel_id,
-                                channel_data['title'])
-
-                            channel_data['url']=language.get(
-                                        'renditions')[0].get('url')
-                        break
 
+                                self._lgr.logger.info(
+                                    'Add first found LiveTV stream '
+                                    'URL to channel `%s` (%s)',
+                                    channel_id,
+                                    channel_data['title'])
+
+                                channel_data['url']=language.get(
+                                            'renditions')[0].get('url')
+
+                            break
+                    else:
+                        self._lgr.logger.warning(
+                            'Cannot collect renditions for channel '
+                            '`%s` (%s)',
+                            channel_id,
+                            channel_data['title'])
                 else:
-                    self._lgr.logger.warning(
-                        'Did not find languages for channel `%s` (%s)',
+
+                    channel_lang = language.get('id').replace('-', '_')
+
+                    self._lgr.logger.info(
+                        'Add language %s to channel `%s` (%s)',
+                        channel_lang,
                         channel_id,
                         channel_data['title'])
 
-    def _collect_epg(self) -> None:
-        """ Collect EPG programs for EPG channels """
+                    channel_data['language'] = channel_lang
+
+                    self._lgr.logger.warning(
+                        'Cannot collect default LiveTV '
+                        'rendition for channel `%s` (%s)',
+                        channel_id,
+                        channel_data['title'])
+                    self._lgr.logger.info(
+                        'Add first found LiveTV stream '
+                        'URL to channel `%s` (%s)',
+                        channel_id,
+                        channel_data['title'])
 
-        for channel_id, channel_data in self._channels.items():
+                    channel_data['url']=language.get(
+                                'renditions')[0].get('url')
+                break
 
-            self._lgr.logger.info('Collect EPG for channel `%s` (%s)',
+        else:
+            self._lgr.logger.warning(
+                'Did not find languages for channel `%s` (%s)',
                 channel_id,
                 channel_data['title'])
 
-            response_channel_epg = self._http_request(
-                    method='GET',
-                    url=f'{self._base_url}/channels/'
-                            f'{channel_id}/programs',
-                    headers={
-                        'User-Agent': self._user_agent,
-                        'Accept': 'application/json'
-                    }
+    def _fetch_channel_epg(self, channel_id: str=None,
+                            channel_data: dict=None) -> list[tuple] | None:
+        """
+        Request and parse EPG programs of the channel, return None if the
+        request failed or the response is malformed
+        """
+
+        self._lgr.logger.info('Collect EPG for channel `%s` (%s)',
+            channel_id,
+            channel_data['title'])
+
+        response_channel_epg = self._http_request(
+                method='GET',
+                url=f'{self._base_url}/channels/'
+                        f'{channel_id}/programs',
+                headers={
+                    'User-Agent': self._user_agent,
+                    'Accept': 'application/json'
+                },
+                endpoint='programs',
+                fatal=False
+            )
+
+        if (response_channel_epg is None
+            or response_channel_epg.status_code != requests.codes.ok): # pylint: disable=no-member
+
+            self._metrics.count_error('epg_fetch')
+            self._lgr.logger.warning(
+                'Cannot collect EPG for channel `%s` (%s): error %s',
+                channel_id,
+                channel_data['title'],
+                response_channel_epg.status_code
+                    if response_channel_epg is not None else 'no response'
                 )
 
-            if (response_channel_epg is None
-                or response_channel_epg.status_code != requests.codes.ok): # pylint: disable=no-member
+            return None
 
-                self._lgr.logger.warning(
-                    'Cannot collect EPG for channel `%s` (%s): error %s',
+        try:
+            return parse_programs(response_channel_epg.content,
+                                    self._epg_window)
+        except PARSE_ERRORS as err:
+            self._metrics.count_error('epg_parse')
+            self._lgr.logger.warning(
+                'Cannot parse EPG for channel `%s` (%s): %s',
+                channel_id,
+                channel_data['title'],
+                err)
+
+            return None
+
+    def _collect_channel_epg(self, channel_id: str=None,
+                                channel_data: dict=None) -> None:
+        """
+        Collect EPG programs for EPG channel
+
+        With EPG state enabled the programs of the previous run are reused
+        as long as they cover the refresh horizon, otherwise they are merged
+        with the collected ones
+        """
+
+        schedule = []
+
+        if self._epg_state is not None:
+            fingerprint = self._epg_state.make_fingerprint(channel_data)
+            schedule = [
+                row for row in self._epg_state.get_schedule(
+                                                    channel_id, fingerprint)
+                if in_window(row[0], row[1], self._epg_window)
+            ]
+
+            if self._epg_state.is_complete(schedule,
+                    self._epg_window[1] if self._epg_window else None):
+                self._lgr.logger.info(
+                    'Reuse %d EPG programs of channel `%s` (%s)',
+                    len(schedule),
                     channel_id,
-                    channel_data['title'],
-                    response_channel_epg.status_code
-                    )
-            else:
-                response_channel_epg_json = response_channel_epg.json()
+                    channel_data['title'])
 
-                if (response_channel_epg_json.get('programs')
-                    and len(response_channel_epg_json.get('programs')) > 0):
+                channel_data['program'] = [
+                    self._make_program_entry(channel_id, channel_data, *row)
+                    for row in schedule
+                ]
+                self._epg_state.update(channel_id, fingerprint, schedule)
 
-                    channel_data['program'] = []
+                return
 
-                    self._lgr.logger.info(
-                        'Add EPG programs to channel `%s` (%s)',
-                        channel_id,
-                        channel_data['title'])
+        if self._epg_share is not None:
+            programs, shared = self._epg_share.fetch(channel_id,
+                    lambda: self._fetch_channel_epg(channel_id, channel_data))
 
-                    for program in response_channel_epg_json.get('programs'):
-                        start = program.get('scheduleInfo').get('start')
-                        stop = program.get('scheduleInfo').get('end')
-                        ptitle = program.get('metaInfo').get('title')
-                        desc = program.get('metaInfo').get('description')
-                        icon = program.get('mediaInfo').get(
-                                                    'thumbnails')[0].get('url')
+            if shared:
+                self._metrics.observe_cache_hit('programs')
+                self._lgr.logger.info(
+                    'Reuse EPG of channel `%s` (%s) collected for another '
+                    'account', channel_id, channel_data['title'])
+        else:
+            programs = self._fetch_channel_epg(channel_id, channel_data)
 
-                        self._lgr.logger.debug(
-                            'Add EPG program to channel `%s` (%s): %s (%s-%s)',
-                            channel_id,
-                            channel_data['title'],
-                            ptitle,
-                            datetime.fromtimestamp(start).astimezone(
-                                ).strftime('%Y-%m-%d %H:%M:%S %z'),
-                            datetime.fromtimestamp(stop).astimezone(
-                                ).strftime('%Y-%m-%d %H:%M:%S %z'),
-                        )
-
-                        channel_data['program'].append(
-                                {
-                                    'start': start,
-                                    'stop': stop,
-                                    'title': ptitle,
-                                    'desc': desc,
-                                    'icon': icon
-                                }
-                            )
-                else:
-                    self._lgr.logger.warning(
-                        'List of EPG programs is empty for channel `%s` (%s)',
+        if programs:
+
+            channel_data['program'] = []
+
+            self._lgr.logger.info(
+                'Add EPG programs to channel `%s` (%s)',
+                channel_id,
+                channel_data['title'])
+
+            for start, stop, ptitle, desc, icon in programs:
+                if self._lgr.logger.isEnabledFor(logging.DEBUG):
+                    self._lgr.logger.debug(
+                        'Add EPG program to channel `%s` (%s): %s (%s-%s)',
                         channel_id,
-                        channel_data['title'])
+                        channel_data['title'],
+                        ptitle,
+                        datetime.fromtimestamp(start).astimezone(
+                            ).strftime('%Y-%m-%d %H:%M:%S %z'),
+                        datetime.fromtimestamp(stop).astimezone(
+                            ).strftime('%Y-%m-%d %H:%M:%S %z'),
+                    )
+
+                channel_data['program'].append(
+                        self._make_program_entry(channel_id, channel_data,
+                            start, stop, ptitle, desc, icon)
+                    )
+        elif programs is not None:
+            self._lgr.logger.warning(
+                'List of EPG programs is empty for channel `%s` (%s)',
+                channel_id,
+                channel_data['title'])
+
+        if self._epg_state is not None:
+            self._merge_epg_schedule(
+                            channel_id, channel_data, fingerprint, schedule)
+
+    def _merge_epg_schedule(self, channel_id: str=None,
+                                channel_data: dict=None,
+                                fingerprint: str=None,
+                                schedule: list[list]=None) -> None:
+        """
+        Prepend collected EPG programs with not yet aired programs of the
+        previous run they do not overlap, and keep the result as EPG state
+        """
+
+        programs = channel_data.get('program', [])
+        first_start = min((program.start for program in programs),
+                            default=float('inf'))
+        kept_programs = [
+            self._make_program_entry(channel_id, channel_data, *row)
+            for row in schedule if row[0] < first_start
+        ]
+
+        if kept_programs:
+            self._lgr.logger.info(
+                'Keep %d EPG programs of channel `%s` (%s) from EPG state',
+                len(kept_programs),
+                channel_id,
+                channel_data['title'])
+
+            programs = kept_programs + programs
+            channel_data['program'] = programs
+
+        self._epg_state.update(channel_id, fingerprint, [
+            [program.start, program.stop, program.title,
+             program.desc, program.icon]
+            for program in programs
+        ])
+
+    @staticmethod
+    def _make_program_entry(channel_id: str=None, channel_data: dict=None,
+                            start: int=None, stop: int=None, title: str=None,
+                            desc: str=None, icon: str=None) -> EPGProgramEntry:
+        """ Create EPG program entry sharing the channel attributes """
+
+        # Titles repeat a lot across the schedule (news, series)
+        if isinstance(title, str):
+            title = sys.intern(title)
+
+        return EPGProgramEntry(
+            channel_id=channel_id,
+            category=channel_data['groups'],
+            start=start,
+            stop=stop,
+            title=title,
+            desc=desc,
+            icon=icon
+        )
 
     def get_channels(self):
         """ Return EPG channels list """
 
         return self._channels
 
+    def collect(self) -> None:
+        """ Collect data of the collected channels """
+
+        self._collect_all()
+
+    def refresh(self) -> None:
+        """
+        Collect channels and their data again within the same session. The
+        channels collected on creation are used by the first refresh
+        """
+
+        if not self._channels_fresh:
+            self._collect_channels()
+        self._channels_fresh = False
+
+        self.collect()
+
+    def resolve_stream(self, channel_id: str=None) -> str | None:
+        """
+        Resolve media stream URL of the channel on demand. Resolved URLs are
+        reused for the stream TTL, raise KeyError if the channel is not
+        collected
+        """
+
+        now = time.monotonic()
+
+        with self._stream_urls_lock:
+            url, expires = self._stream_urls.get(channel_id, (None, 0))
+        if url is not None and expires > now:
+            return url
+
+        channel_data = self._channels.get(channel_id)
+        if channel_data is None:
+            self._lgr.logger.warning(
+                'Cannot resolve LiveTV stream of unknown channel `%s`',
+                channel_id)
+            raise KeyError(channel_id)
+
+        # Do not touch the collected channel, it may be rendered right now
+        channel_data = dict(channel_data)
+        channel_data.pop('url', None)
+        self._collect_channel_stream(channel_id, channel_data)
+
+        url = channel_data.get('url')
+        if url is not None:
+            with self._stream_urls_lock:
+                self._stream_urls[channel_id] = (url, now + self._stream_ttl)
+
+        return url
+
+    def iter_channels(self) -> Iterator[tuple[str, dict]]:
+        """
+        Collect and yield channels one by one in channel order. EPG programs
+        of a channel are released once the consumer moves to the next one
+        """
+
+        for channel_id, channel_data in self._iter_collected():
+            yield channel_id, channel_data
+            channel_data.pop('program', None)
+
 if __name__ == '__main__':
 
     Logger().logger.critical(
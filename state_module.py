@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+""" Smotreshka LiveTV Ripper: State Module """
+
+import hashlib
+import json
+import sys
+import time
+from pathlib import Path
+from logger_module import Logger
+from output_module import atomic_open
+
+class EPGState:
+    """
+    EPG schedules from the previous run to refresh EPG incrementally
+
+    Schedules are stored per channel as rows of
+    [start, stop, title, desc, icon] along with a fingerprint of the channel
+    metadata, so a schedule is discarded once the channel changes
+    """
+
+    def __init__(self, file: str=None, horizon: int=86400,
+                    loglevel: int=20) -> None:
+
+        self._lgr = Logger(loglevel=loglevel, classname=self.__class__.__name__)
+        self._file = Path(file)
+        self._horizon = horizon
+        self._now = time.time()
+        self._previous: dict[str, dict] = {}
+        self._current: dict[str, dict] = {}
+
+        self._load()
+
+    def _load(self) -> None:
+        """ Load schedules from the state file if exists """
+
+        if not self._file.exists():
+            self._lgr.logger.info(
+                'EPG state file %s does not exist, collect full EPG',
+                self._file)
+            return
+
+        try:
+            self._previous = json.loads(
+                self._file.read_text(encoding='utf8')).get('channels', {})
+        except (OSError, ValueError) as err:
+            self._lgr.logger.warning(
+                'Cannot load EPG state file %s, collect full EPG: %s',
+                self._file, err)
+            return
+
+        self._lgr.logger.info('Loaded EPG state for %d channels from %s',
+            len(self._previous), self._file)
+
+    def start_collection(self) -> None:
+        """ Take the current time for the collection about to start """
+
+        self._now = time.time()
+        self._current = {}
+
+    @staticmethod
+    def make_fingerprint(channel_data: dict=None) -> str:
+        """ Return fingerprint of the channel metadata """
+
+        return hashlib.sha256(json.dumps([
+            channel_data['number'],
+            channel_data['title'],
+            channel_data['groups'],
+            channel_data['logo']
+        ], ensure_ascii=False).encode('utf8')).hexdigest()
+
+    def get_schedule(self, channel_id: str=None,
+                        fingerprint: str=None) -> list[list]:
+        """ Return not yet aired programs of the unchanged channel """
+
+        channel_state = self._previous.get(channel_id)
+
+        if channel_state is None or channel_state['fingerprint'] != fingerprint:
+            return []
+
+        return [row for row in channel_state['programs'] if row[1] > self._now]
+
+    def is_complete(self, schedule: list[list]=None,
+                    until: float=None) -> bool:
+        """
+        Check the schedule does not end within the refresh horizon, the
+        horizon is capped at the end of the EPG window if set
+        """
+
+        horizon = self._now + self._horizon
+        if until is not None:
+            horizon = min(horizon, until)
+
+        return bool(schedule) and max(row[1] for row in schedule) >= horizon
+
+    def update(self, channel_id: str=None, fingerprint: str=None,
+                schedule: list[list]=None) -> None:
+        """ Set the channel schedule to be saved """
+
+        self._current[channel_id] = {
+            'fingerprint': fingerprint,
+            'programs': schedule
+        }
+
+    def save(self) -> None:
+        """
+        Save schedules of the current collection to the state file, they
+        become the previous ones for the next collection of the process
+        """
+
+        with atomic_open(file=self._file) as state_file:
+            json.dump({'channels': self._current}, state_file,
+                        ensure_ascii=False)
+
+        self._lgr.logger.info('Saved EPG state for %d channels to %s',
+            len(self._current), self._file)
+
+        self._previous = self._current
+        self._current = {}
+
+if __name__ == '__main__':
+
+    Logger().logger.critical(
+        'This module must not be run as a standalone application')
+
+    # sysexits.h: EX_OSERR
+    sys.exit(71)